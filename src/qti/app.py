@@ -5,6 +5,7 @@ from . import library
 from . import browser
 from . import settings
 from . import cache
+from . import cache_daemon
 from . import keys
 from . import macros
 from . import timer
@@ -21,7 +22,7 @@ from .dialogs.metadata_editor import MetadataEditorDialog
 from .dialogs.macros import MacroDialog
 from .dialogs.app_settings import AppSettingsDialog
 from .dialogs.key_config import KeybindDialog
-from .background import BackgroundCacher
+from .background import CACHERS
 from .dialogs.search import SearchDialog
 from .datastore import Datastore
 
@@ -32,9 +33,13 @@ class Application:
         self.settings = settings.Settings(self.store)
         self.ui = ui.cls('app')(self.settings, self.handle_keydown, self.exit_hook, self.idle_cb)
         self.keybinds = keys.Keybinds(self.store)
-        self.library = library.Library(json_file)
+        self.library = library.open_library(json_file)
         self.metadata = self.library.metadata
         cache.set_root_dir(self.library.root_dir)
+        cache.set_backend(self.settings.cache_backend)
+        cache.set_quality(self.settings.cache_quality)
+        cache.set_format(self.settings.cache_format)
+        cache.set_scope(self.settings.cache_scope)
         for macro in self.library.macros:
             self.keybinds.add_action('macro_' + macro['name'])
         self.filter_config = default_filter_config(self.library)
@@ -43,12 +48,14 @@ class Application:
         self.ui.set_main_widget(self.browser.ui)
         self.size = self.ui.size
         self.window = self.ui.window
+        self.cacher = CACHERS[self.settings.cache_mode](self)
+        self.autosave_timer = self.timer(self.library.autosave, repeat=True)
         self.browser.load_node(self.library.make_tree(self.filter_config), mode='grid')
-        self.cacher = BackgroundCacher(self)
         self.apply_settings()
         self.snapshots = []
 
     def handle_keydown(self, keystroke):
+        self.cacher.user_active()
         action = self.keybinds.get_action(keystroke)
         if action == 'quit':
             self.ui.quit()
@@ -101,11 +108,20 @@ class Application:
         return timer.Timer(self, *args, **kwargs)
 
     def exit_hook(self):
-        self.library.save()
+        self.library.close()
         self.cacher.stop()
 
     def apply_settings(self):
         self.ui.apply_settings(self.settings.to_dict())
+        cache.set_backend(self.settings.cache_backend)
+        cache.set_quality(self.settings.cache_quality)
+        cache.set_format(self.settings.cache_format)
+        cache.set_scope(self.settings.cache_scope)
+        cache.set_daemon(cache_daemon.make_client()) # Only if it caches the way we now do
+        self.autosave_timer.start(self.settings.autosave_period)
+        if type(self.cacher) is not CACHERS[self.settings.cache_mode]:
+            self.cacher.stop()
+            self.cacher = CACHERS[self.settings.cache_mode](self)
         self.browser.reload_node()
         self.cacher.cache_all_images()
 
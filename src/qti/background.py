@@ -1,43 +1,336 @@
+import collections
+import json
+import os
 import select
 import subprocess
+import threading
+import time
+
+from . import cache_daemon
+from .cache import Manifest, ensure_all_cached, source_stamp
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm' % (hours, minutes)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % (seconds,)
 
 
 class BackgroundCacher:
+    """
+    Keeps a qti-image-cacher running in watch mode for the lifetime of the app.
+    cache_all_images is called whenever the settings change; it does nothing if
+    the sizes we need are unchanged, and otherwise tells the running cacher about
+    the new sizes. It is only restarted if the backend, quality or format changes.
+
+    If a qti-cache-daemon is running for the library with the same backend,
+    format and scope as us, we use that instead of starting our own cacher (in
+    which case the daemon's quality applies).
+    """
     poll_interval_s = 1.0
+    pause_s = 2.0
+    placeholders = False
 
     def __init__(self, app):
         self.app = app
         self.timer = app.timer(self.poll, repeat=True)
-        self.done = None
-        self.total = None
+        self.progress = None
+        self.partial = b''
         self.proc = None
+        self.daemon = None
+        self.input = self.output = None
+        self.sizes = None
+        self.config = None
+        self.paused_until = 0
+
+    def wanted_sizes(self):
+        return [tuple(self.app.size), tuple(self.app.settings.thumbnail_size)]
 
     def cache_all_images(self):
-        sizes = [self.app.size,
-                 self.app.settings.thumbnail_size]
-        cmd = ['qti-image-cacher', self.app.library.root_dir]
-        for size in sizes:
-            cmd += ['-s', '%dx%d' % tuple(size)]
-        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        self.app.browser.grid.set_placeholders(self.placeholders)
+        sizes = self.wanted_sizes()
+        config = (self.app.settings.cache_backend, self.app.settings.cache_quality,
+                  self.app.settings.cache_format, self.app.settings.cache_scope)
+        if self.output is not None and config == self.config:
+            if sizes != self.sizes:
+                self.sizes = sizes
+                self.send({'sizes': sizes})
+                self.timer.start(self.poll_interval_s)
+            return
+
+        self.stop()
+        self.sizes = sizes
+        self.config = config
+        client = cache_daemon.make_client(self.app.library.root_dir)
+        self.daemon = client and client.sock
+        if self.daemon:
+            self.input = self.daemon.makefile('wb')
+            self.output = self.daemon.makefile('rb')
+            self.send({'sizes': sizes, 'subscribe': True})
+        else:
+            cmd = ['qti-image-cacher', self.app.library.path, '--listen', '--watch',
+                   '--backend', self.app.settings.cache_backend,
+                   '--quality', self.app.settings.cache_quality,
+                   '--format', self.app.settings.cache_format,
+                   '--scope', self.app.settings.cache_scope]
+            for size in sizes:
+                cmd += ['-s', '%dx%d' % size]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.input, self.output = self.proc.stdin, self.proc.stdout
         self.timer.start(self.poll_interval_s)
 
+    def send(self, command):
+        if self.input is None:
+            return
+        try:
+            self.input.write(json.dumps(command).encode() + b'\n')
+            self.input.flush()
+        except OSError: # The cacher has exited
+            pass
+
+    def prioritise(self, image_paths):
+        # Ask the cacher to deal with these images before anything else
+        self.send({'prioritise': list(image_paths)})
+
+    def user_active(self):
+        # Hold the cacher off while the user is interacting with us, so that
+        # loading images for display doesn't have to compete with it
+        now = time.time()
+        if now > self.paused_until - self.pause_s / 2:
+            self.paused_until = now + self.pause_s
+            self.send({'pause': self.pause_s})
+
     def poll(self):
-        if not select.select([self.proc.stdout], [], [], 0)[0]:
+        if not select.select([self.output], [], [], 0)[0]:
             return
 
-        data = self.proc.stdout.read1(4096)
-        assert data.endswith(b'\n')
-        self.done, self.total = map(int, data.split(b'\n')[-2].split())
+        data = self.output.read1(65536)
+        if not data: # The cacher has exited
+            self.stop()
+            return
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        for line in lines:
+            msg = json.loads(line)
+            if msg['type'] == 'progress':
+                self.progress = msg
+            elif msg['type'] == 'error':
+                print("Failed to cache %s: %s" % (msg['path'], msg['error']))
+        if self.progress:
+            self.show_progress()
 
-        text = "Cached %d / %d images" % (self.done, self.total)
-        if self.done < self.total:
+    def show_progress(self):
+        done, total, failed = self.progress['done'], self.progress['total'], self.progress['failed']
+        text = "Cached %d / %d images" % (done, total)
+        if failed:
+            text += " (%d failed)" % (failed,)
+        if done < total:
+            text += ", %.1f/s" % (self.progress['rate'],)
+            if self.progress['eta'] is not None:
+                text += ", %s left" % (format_duration(self.progress['eta']),)
             self.app.status_bar.set_text(text, priority=-10, duration_s=self.poll_interval_s * 1.25)
         else:
             self.app.status_bar.set_text(text, duration_s=5)
-            self.stop()
 
     def stop(self):
         self.timer.stop()
         if self.proc:
             self.proc.terminate()
             self.proc = None
+        if self.daemon:
+            self.daemon.close()
+            self.daemon = None
+        self.input = self.output = None
+        self.partial = b''
+
+
+class ThreadedCacher(BackgroundCacher):
+    """
+    Caches images using a pool of threads in the GUI process, rather than in a
+    qti-image-cacher subprocess. Pillow releases the GIL while decoding and scaling,
+    so the threads can still keep several cores busy. Each image is handed to the
+    grid as soon as it is cached, so the grid can show blank cells rather than
+    waiting for images that are not yet ready.
+
+    When the sizes change, any running threads carry on with a new plan covering
+    the new sizes; images already cached at those sizes are skipped cheaply.
+    """
+    placeholders = True
+    niceness = 10
+    paused_poll_s = 0.05
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.n_threads = max(1, min(4, (os.cpu_count() or 1) - 1))
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.running = 0
+        self.images = iter(())
+        self.resolutions = {}
+        self.urgent = collections.deque()
+        self.seen = set()
+        self.manifests = []
+        self.start_time = None
+        self.n_cached = 0
+
+    def cache_all_images(self):
+        self.app.browser.grid.set_placeholders(self.placeholders)
+        sizes = self.wanted_sizes()
+        config = (self.app.settings.cache_backend, self.app.settings.cache_format,
+                  self.app.settings.cache_scope)
+        if (sizes, config) == (self.sizes, self.config):
+            return
+        images = list(self.app.library.images())
+        with self.lock:
+            # Manifests describe the cached images of one backend and format, so
+            # can't be reused across them
+            reusable = {manifest.size: manifest for manifest in self.manifests
+                        if config == self.config}
+            self.sizes = sizes
+            self.config = config
+            self.manifests = [reusable.get(size) or Manifest(size) for size in sizes]
+            self.images = iter(image.abspath for image in images)
+            self.resolutions = {image.abspath: image.spec.get('resolution') for image in images}
+            self.seen = set()
+            self.progress = {'done': 0, 'total': len(images), 'failed': 0, 'rate': 0, 'eta': None}
+            self.start_time = time.time()
+            self.n_cached = 0
+            new_threads = self.n_threads - self.running
+            self.running = self.n_threads
+        self.start_threads(new_threads)
+
+    def start_threads(self, n):
+        for _ in range(n):
+            threading.Thread(target=self.work, args=(self.generation,), daemon=True).start()
+        self.timer.start(self.poll_interval_s)
+
+    def prioritise(self, image_paths):
+        with self.lock:
+            self.urgent = collections.deque(image_paths)
+            for image_path in self.urgent:
+                if image_path not in self.resolutions:
+                    # Not in the library yet, e.g. an image that is being imported
+                    self.resolutions[image_path] = None
+                    if self.progress:
+                        self.progress['total'] += 1
+            # The threads exit once they run out of work, so start more if
+            # there is something new to do
+            new_threads = 0
+            if self.sizes is not None:
+                unseen = sum(image_path not in self.seen for image_path in self.urgent)
+                new_threads = min(unseen, self.n_threads - self.running)
+                self.running += new_threads
+        if new_threads:
+            self.start_threads(new_threads)
+
+    def next_image(self, backlog=True):
+        while self.urgent:
+            image_path = self.urgent.popleft()
+            if image_path not in self.seen:
+                self.seen.add(image_path)
+                return image_path
+        if not backlog:
+            return None
+        for image_path in self.images:
+            if image_path not in self.seen:
+                self.seen.add(image_path)
+                return image_path
+        return None
+
+    def user_active(self):
+        self.paused_until = time.time() + self.pause_s
+
+    def work(self, generation):
+        try: # Linux lets us lower the priority of a single thread
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            with self.lock:
+                if generation != self.generation:
+                    return
+                # While the user is busy we only cache the images they're
+                # looking at, which the grid is showing as blank until we do
+                paused = time.time() < self.paused_until
+                image_path = self.next_image(backlog=not paused)
+                if image_path is None and not paused:
+                    self.running -= 1
+                    if self.running == 0:
+                        self.app.ui.call_from_thread(self.finished)
+                    return
+                resolution = self.resolutions.get(image_path)
+                manifests = list(self.manifests)
+            if image_path is None:
+                time.sleep(min(self.paused_poll_s, max(0, self.paused_until - time.time())))
+                continue
+
+            # Checking the source can mean hashing it (with the global scope) or
+            # locking the pack, so is done without holding up the other threads
+            try:
+                stamp = source_stamp(image_path)
+                manifests = [manifest for manifest in manifests
+                             if not manifest.is_cached(image_path, stamp)]
+            except FileNotFoundError:
+                manifests = []
+            if not manifests:
+                with self.lock:
+                    if generation != self.generation:
+                        return
+                    self.progress['done'] += 1
+                continue
+
+            error = None
+            try:
+                ensure_all_cached(image_path, [manifest.size for manifest in manifests], resolution)
+            except Exception as e:
+                error = '%s: %s' % (type(e).__name__, e)
+
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.progress['done'] += 1
+                if error:
+                    self.progress['failed'] += 1
+                    print("Failed to cache %s: %s" % (image_path, error))
+                    continue
+                self.n_cached += 1
+                for manifest in manifests:
+                    manifest.add(image_path, stamp)
+            self.app.ui.call_from_thread(self.app.browser.grid.image_cached, image_path)
+
+    def poll(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            rate = self.n_cached / elapsed if elapsed else 0
+            remaining = self.progress['total'] - self.progress['done']
+            self.progress['rate'] = rate
+            self.progress['eta'] = remaining / rate if rate else None
+        self.show_progress()
+
+    def finished(self):
+        with self.lock:
+            if self.running: # Restarted since the last thread exited
+                return
+            for manifest in self.manifests:
+                manifest.save()
+        self.timer.stop()
+        self.poll()
+
+    def stop(self):
+        self.timer.stop()
+        with self.lock:
+            # Any threads still running exit once they notice the generation change
+            self.generation += 1
+            self.running = 0
+            self.sizes = self.config = None
+            for manifest in self.manifests:
+                manifest.save()
+
+
+CACHERS = {
+    'process': BackgroundCacher,
+    'threads': ThreadedCacher,
+}
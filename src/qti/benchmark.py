@@ -0,0 +1,143 @@
+import argparse
+import gc
+import os
+import resource
+import time
+import types
+
+from . import cache
+from . import metadata
+from . import tree
+from .cache import FORMATS, encode_image, open_image, read_raw, scale_image_to_sizes
+from .image_cacher import format_bytes, load_images, parse_size
+
+
+def qt_decoder():
+    # Decoding with Qt is what the grid actually pays for, so prefer it if we can
+    try:
+        from PySide6.QtGui import QImage
+    except ImportError:
+        return None
+    def decode(data):
+        raw = read_raw(data)
+        if raw:
+            width, height, pixels = raw
+            return QImage(pixels, width, height, 4 * width, QImage.Format_ARGB32_Premultiplied).copy()
+        return QImage.fromData(data)
+    return decode
+
+
+def pil_decode(data):
+    return open_image(data).load()
+
+
+def benchmark_formats(options):
+    root_dir, image_paths, _ = load_images(options.library)
+    cache.set_root_dir(root_dir)
+    images = []
+    for image_path in image_paths[:options.count]:
+        try:
+            images += [image for _, image in scale_image_to_sizes(image_path, [options.size])]
+        except Exception as e:
+            print("Skipping %s: %s" % (image_path, e))
+    if not images:
+        print("No images to benchmark")
+        return
+
+    decode = qt_decoder()
+    print("%d images at %dx%d, decoded from memory with %s" % (
+        len(images), *options.size, 'Qt' if decode else 'Pillow'))
+    decode = decode or pil_decode
+    print("%-6s %12s %12s %12s" % ('format', 'size/image', 'encode/image', 'decode/image'))
+    for fmt in FORMATS:
+        try:
+            cache.set_format(fmt)
+        except ValueError as e:
+            print("%-6s %s" % (fmt, e))
+            continue
+        t0 = time.perf_counter()
+        encoded = [encode_image(image) for image in images]
+        t1 = time.perf_counter()
+        for data in encoded:
+            decode(data)
+        t2 = time.perf_counter()
+        n = len(images)
+        print("%-6s %12s %10.2fms %10.2fms" % (
+            fmt, format_bytes(sum(map(len, encoded)) / n),
+            1000 * (t1 - t0) / n, 1000 * (t2 - t1) / n))
+
+
+def rss():
+    # Current resident set size in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError: # Not Linux; peak is the best we can do
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synthetic_specs(count):
+    # Roughly the shape of a real library: a two-level hierarchy and a few tags
+    # per image. Every string is a fresh object, as it would be from json.load.
+    for i in range(count):
+        yield {
+            'name': 'image %d' % (i,),
+            'path': 'artist%d/album%d/%08d.jpg' % (i % 2000, i % 20000, i),
+            'resolution': [4000, 3000],
+            'artist': 'artist%d' % (i % 2000,),
+            'album': 'album%d' % (i % 20000,),
+            'tags': ['tag%d' % (i % 97,), 'tag%d' % (i % 89,)] if i % 3 else [],
+        }
+
+
+def benchmark_memory(options):
+    md = metadata.Metadata()
+    md.add_key('artist', in_hierarchy=True)
+    md.add_key('album', in_hierarchy=True)
+    md.add_key('tags', multi=True)
+    filter_config = types.SimpleNamespace(group_by=['artist', 'album'], order_by=[], filter=None)
+
+    gc.collect()
+    before = rss()
+    t0 = time.perf_counter()
+    # Specs are generated as they're needed, so that we measure what the tree
+    # keeps rather than what the allocator kept hold of after loading
+    base_tree = tree.BaseTree('/library', md, synthetic_specs(options.count))
+    gc.collect()
+    t1 = time.perf_counter()
+    built = rss()
+    filtered_tree = tree.FilteredTree(base_tree, filter_config)
+    gc.collect()
+    t2 = time.perf_counter()
+    filtered = rss()
+
+    print("%d images" % (options.count,))
+    print("%-14s %10s %10s %10s" % ('tree', 'time', 'rss', 'per image'))
+    for stage, t, used in [('base', t1 - t0, built - before),
+                           ('filtered', t2 - t1, filtered - built)]:
+        print("%-14s %9.2fs %10s %9dB" % (stage, t, format_bytes(used), used / options.count))
+
+
+def main():
+    options = parse_cmdline()
+    options.func(options)
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Measure qti performance on this machine')
+    subparsers = parser.add_subparsers(required=True)
+
+    formats = subparsers.add_parser('formats', help='Compare cache formats')
+    formats.set_defaults(func=benchmark_formats)
+    formats.add_argument('library', metavar='LIBRARY',
+                         help='Library JSON file, or root directory to search for images under')
+    formats.add_argument('-s', '--size', metavar='WIDTHxHEIGHT', type=parse_size,
+                         default=(250, 200), help='Size to scale images to (default: 250x200)')
+    formats.add_argument('-n', '--count', type=int, default=100,
+                         help='Number of images to use (default: 100)')
+
+    memory = subparsers.add_parser('memory', help='Measure the memory used by a large synthetic library')
+    memory.set_defaults(func=benchmark_memory)
+    memory.add_argument('-n', '--count', type=int, default=1000000,
+                        help='Number of images (default: 1000000)')
+    return parser.parse_args()
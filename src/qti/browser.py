@@ -34,6 +34,7 @@ class Browser:
                                     keydown_cb=self.handle_keydown)
 
     def _target_updated(self, target_i):
+        self.app.cacher.user_active()
         self.target = None if target_i is None else self.node.children[target_i]
         self.pathbar.set_target(self.target)
 
@@ -59,6 +60,7 @@ class Browser:
                 for child in self.node.children
             ]
             target_i = self.node.children.index(self.target) if self.target else None
+            self.app.cacher.prioritise(cell['image_path'] for cell in cells)
             self.grid.load(cells, target_i=target_i)
         else:
             self.pathbar.fade_target = False
@@ -1,5 +1,19 @@
+import atexit
+import contextlib
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import mmap
 import os
-from PIL import Image
+import re
+import shutil
+import struct
+import threading
+import time
+import zlib
+from PIL import Image, features
 
 
 ROOT_DIR = None
@@ -8,25 +22,872 @@ def set_root_dir(root_dir): # Called by App.__init__
     ROOT_DIR = root_dir
 
 
+BACKEND = 'files'
+def set_backend(backend):
+    global BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("Unknown cache backend %r" % (backend,))
+    BACKEND = backend
+
+
+# quality -> (resampling filter, reducing_gap). See PIL.Image.resize for details of
+# reducing_gap; a smaller gap trades quality for speed, and None disables it, always
+# decoding and resampling from the full size image.
+QUALITIES = {
+    'fast': (Image.Resampling.BILINEAR, 1.0),
+    'balanced': (Image.Resampling.BICUBIC, 3.0),
+    'best': (Image.Resampling.LANCZOS, None),
+}
+
+QUALITY = 'balanced'
+def set_quality(quality):
+    global QUALITY
+    if quality not in QUALITIES:
+        raise ValueError("Unknown cache quality %r" % (quality,))
+    QUALITY = quality
+
+
+# format -> file extension. jpeg is smallest; webp (lossless) decodes a little
+# faster; raw is premultiplied ARGB32, which Qt can use without decoding at all,
+# at the cost of a lot of disk; rawz is raw compressed with a fast zlib level.
+FORMATS = {
+    'jpeg': '.jpg',
+    'webp': '.webp',
+    'raw': '.argb',
+    'rawz': '.argbz',
+}
+
+FORMAT = 'jpeg'
+def set_format(fmt):
+    global FORMAT
+    if fmt not in FORMATS:
+        raise ValueError("Unknown cache format %r" % (fmt,))
+    if fmt == 'webp' and not features.check('webp'):
+        raise ValueError("This build of Pillow does not support WebP")
+    FORMAT = fmt
+
+
+def format_suffix():
+    # Distinguishes files (packs, manifests) holding other formats from jpeg ones,
+    # which keep their original names
+    return '' if FORMAT == 'jpeg' else '.' + FORMAT
+
+
+# Our raw formats are a header followed by the pixels as Qt's premultiplied ARGB32,
+# i.e. native-endian 0xAARRGGBB words; on the little-endian machines we run on,
+# that is B, G, R, A in memory. rawz compresses the pixels with zlib.
+RAW_HEADER = struct.Struct('<8sII') # magic, width, height
+RAW_MAGIC = b'QTIARGB\x00'
+RAWZ_MAGIC = b'QTIARGBZ'
+RAW_MODE = 'BGRa'
+
+def read_header(source):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            header = f.read(RAW_HEADER.size)
+    else:
+        header = bytes(source[:RAW_HEADER.size])
+    if len(header) == RAW_HEADER.size and header[:8] in (RAW_MAGIC, RAWZ_MAGIC):
+        return RAW_HEADER.unpack(header)
+    return None
+
+
+def read_raw(source):
+    """
+    If source (a path, or encoded image data) is in one of our raw formats,
+    returns (width, height, pixels), else None. Uncompressed files are mapped
+    rather than read, so no pixels are copied until they are used.
+    """
+    header = read_header(source)
+    if header is None:
+        return None
+    magic, width, height = header
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if magic == RAW_MAGIC:
+                pixels = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                pixels = f.read()
+    else:
+        pixels = memoryview(source)
+    pixels = pixels[RAW_HEADER.size:]
+    if magic == RAWZ_MAGIC:
+        pixels = zlib.decompress(pixels)
+    return width, height, pixels
+
+
+def image_size(source):
+    header = read_header(source)
+    if header:
+        return header[1:]
+    return Image.open(source if isinstance(source, str) else io.BytesIO(source)).size
+
+
+def open_image(source):
+    # Opens a PIL image from a path or encoded data, in any of our formats
+    raw = read_raw(source)
+    if raw:
+        width, height, pixels = raw
+        return Image.frombuffer('RGBa', (width, height), pixels, 'raw', RAW_MODE, 0, 1)
+    return Image.open(source if isinstance(source, str) else io.BytesIO(source))
+
+
+DAEMON = None
+def set_daemon(client): # A cache_daemon.Client, or None to cache images ourselves
+    global DAEMON
+    DAEMON = client
+
+
+# With the 'library' scope, each library has its own cache in .cache under its root.
+# With the 'global' scope, every library shares one cache, in which images are
+# keyed by a digest of their contents, so identical files in several libraries
+# (e.g. hard links or copies) are only cached once.
+SCOPES = ('library', 'global')
+GLOBAL_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                'qti')
+
+SCOPE = 'library'
+def set_scope(scope):
+    global SCOPE
+    if scope not in SCOPES:
+        raise ValueError("Unknown cache scope %r" % (scope,))
+    SCOPE = scope
+
+
+def cache_dir():
+    if SCOPE == 'global':
+        return GLOBAL_CACHE_DIR
+    return os.path.join(ROOT_DIR, '.cache')
+
+
+def size_dir(size):
+    return os.path.join(cache_dir(), '%dx%d' % tuple(size))
+
+
+def cache_key(image_path):
+    if SCOPE == 'global':
+        return DIGESTS.digest(image_path)
+    return os.path.relpath(image_path, ROOT_DIR)
+
+
 def cache_path(image_path, size):
-    relpath = os.path.relpath(image_path, ROOT_DIR)
-    as_jpg = os.path.splitext(relpath)[0] + '.jpg'
-    return os.path.join(ROOT_DIR, '.cache', '%dx%d' % tuple(size), as_jpg)
+    # Named by a hash of the image's key, so that images differing only in
+    # extension don't collide, and sharded so that no directory gets too big
+    digest = hashlib.sha1(os.fsencode(cache_key(image_path))).hexdigest()
+    return os.path.join(size_dir(size), digest[:2], digest + FORMATS[FORMAT])
 
 
-def ensure_cached(image_path, size):
-    scaled_path = cache_path(image_path, size)
-    if not os.path.exists(os.path.dirname(scaled_path)):
+def source_stamp(image_path):
+    # Identifies the version of an image that a cached copy was made from. The
+    # size and inode catch replacements that keep the mtime (e.g. cp -p, or a
+    # restore from backup). In the global cache the key already identifies the
+    # contents, and any copy of an image is as good as another.
+    if SCOPE == 'global':
+        return 0
+    st = os.stat(image_path)
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+def stamp_mtime(stamp):
+    return stamp[0] if stamp else 0
+
+
+class DigestIndex:
+    """
+    Persistent record of the content digest of every image we've seen, keyed by
+    device and inode and validated by mtime and size, so that files are only
+    hashed again when they change. Saved on exit, merged with anything other
+    processes have saved since we loaded it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.digests = None # 'dev:ino' -> [mtime_ns, size, digest]
+        self.dirty = False
+        self.lock = threading.Lock()
+        atexit.register(self.save)
+
+    def load(self):
         try:
-            os.makedirs(os.path.dirname(scaled_path))
-        except FileExistsError:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def known(self, image_path, st=None):
+        # Returns the digest if we have it for the current version of the
+        # file, else None, without hashing anything
+        st = st or os.stat(image_path)
+        with self.lock:
+            if self.digests is None:
+                self.digests = self.load()
+            entry = self.digests.get('%d:%d' % (st.st_dev, st.st_ino))
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        return None
+
+    def digest(self, image_path):
+        st = os.stat(image_path)
+        key = '%d:%d' % (st.st_dev, st.st_ino)
+        known = self.known(image_path, st)
+        if known:
+            return known
+        digest = hashlib.blake2b(digest_size=20)
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.digests[key] = [st.st_mtime_ns, st.st_size, digest.hexdigest()]
+            self.dirty = True
+        return digest.hexdigest()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            digests = self.load() | self.digests
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w', encoding='UTF-8') as f:
+                json.dump(digests, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+DIGESTS = DigestIndex(os.path.join(GLOBAL_CACHE_DIR, 'digests.json'))
+
+
+def fit_size(image_size, size):
+    ratio = min(size[0] / image_size[0], size[1] / image_size[1])
+    return (int(image_size[0] * ratio), int(image_size[1] * ratio))
+
+
+def scale_image(image, size):
+    resample, reducing_gap = QUALITIES[QUALITY]
+    return image.resize(fit_size(image.size, size), resample, reducing_gap=reducing_gap)
+
+
+def scale_image_to_sizes(source, sizes):
+    """
+    Yields (size, image) for source scaled to fit each of sizes, from a single
+    decode of it. Sizes are produced largest first, each one scaled down from the
+    last. The source is a path, or the encoded image data itself.
+    """
+    _resample, reducing_gap = QUALITIES[QUALITY]
+    image = open_image(source)
+    sizes = sorted(sizes, key=lambda size: fit_size(image.size, size), reverse=True)
+    largest = fit_size(image.size, sizes[0])
+    # For JPEGs, have the decoder do most of the downscaling for us. This only
+    # decodes as many pixels as we need, which is much faster and uses far less
+    # memory than decoding at full size and then resizing.
+    if reducing_gap:
+        image.draft(None, (int(largest[0] * reducing_gap), int(largest[1] * reducing_gap)))
+    if image.mode not in ('RGB', 'L'): # e.g. RGBA, CMYK, palette, or our raw formats
+        image = image.convert('RGB')
+    for size in sizes:
+        image = scale_image(image, size)
+        yield size, image
+
+
+def encode_image(image):
+    if FORMAT in ('raw', 'rawz'):
+        pixels = image.convert('RGBA').convert('RGBa').tobytes('raw', RAW_MODE)
+        if FORMAT == 'rawz':
+            return RAW_HEADER.pack(RAWZ_MAGIC, *image.size) + zlib.compress(pixels, 1)
+        return RAW_HEADER.pack(RAW_MAGIC, *image.size) + pixels
+    buf = io.BytesIO()
+    if FORMAT == 'webp':
+        image.save(buf, 'WEBP', lossless=True, method=0)
+    else:
+        image.save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+TMP_GRACE_S = 3600
+
+def is_abandoned(st):
+    # Whether a temporary file was left behind by a process that died, rather
+    # than being written now. Its ctime changes with every write and utime.
+    return time.time() - st.st_ctime > TMP_GRACE_S
+
+
+class FileStore:
+    """
+    Stores each cached image as a file under .cache/WxH/, named by a hash of its
+    path (see cache_path). Cached files carry the mtime of the source they were made
+    from, and the rest of its stamp in an extended attribute, so editing or
+    replacing the original invalidates them. Their atime records when they were
+    last used. On filesystems without extended attributes, the mtime is all we
+    have to go on.
+
+    Originals that are no larger than the size are hard linked into the cache
+    rather than copied; a link shares the original's mtime, so is stamped
+    correctly for free, and takes no space, so is not counted in usage(). Links
+    are never touched, as that would change the original's ctime (and so have
+    backup tools copy it again); evicting one would free nothing anyway.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    stamp_attr = 'user.qti.stamp'
+
+    def is_cached(self, image_path, stamp):
+        scaled_path = cache_path(image_path, self.size)
+        try:
+            st = os.stat(scaled_path)
+        except FileNotFoundError:
+            return False
+        if st.st_mtime_ns != stamp_mtime(stamp):
+            return False
+        if not stamp or st.st_ino == stamp[2]: # A link to the original itself
+            return True
+        try:
+            return json.loads(os.getxattr(scaled_path, self.stamp_attr)) == stamp
+        except OSError as e:
+            return e.errno == errno.ENOTSUP # Else ENODATA, i.e. cached before we recorded it
+
+    def get(self, image_path):
+        return cache_path(image_path, self.size)
+
+    def put(self, image_path, stamp, data):
+        scaled_path = cache_path(image_path, self.size)
+        os.makedirs(os.path.dirname(scaled_path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (scaled_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        if stamp:
+            try:
+                os.setxattr(tmp_path, self.stamp_attr, json.dumps(stamp).encode())
+            except OSError as e:
+                if e.errno != errno.ENOTSUP:
+                    raise
+        os.utime(tmp_path, ns=(time.time_ns(), stamp_mtime(stamp)))
+        os.replace(tmp_path, scaled_path)
+        return scaled_path
+
+    def link(self, image_path, stamp):
+        scaled_path = cache_path(image_path, self.size)
+        os.makedirs(os.path.dirname(scaled_path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (scaled_path, os.getpid(), threading.get_ident())
+        try:
+            if SCOPE == 'global': # Links must carry the original's mtime, not our stamp
+                raise OSError()
+            os.link(image_path, tmp_path)
+        except OSError: # e.g. the cache is on another filesystem
+            with open(image_path, 'rb') as f:
+                return self.put(image_path, stamp, f.read())
+        os.replace(tmp_path, scaled_path)
+        return scaled_path
+
+    def touch(self, image_path, stamp):
+        scaled_path = cache_path(image_path, self.size)
+        if os.stat(scaled_path).st_nlink == 1:
+            os.utime(scaled_path, ns=(time.time_ns(), stamp_mtime(stamp)))
+
+    def item(self, image_path):
+        return cache_path(image_path, self.size)
+
+    def usage(self):
+        # item -> (bytes, last access time). Temporary files are only included
+        # once they're too old to still be being written.
+        usage = {}
+        for dirpath, _, filenames in os.walk(size_dir(self.size)):
+            for filename in filenames:
+                if filename.endswith((*FORMATS.values(), '.tmp')):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError: # A temporary file, since renamed
+                        continue
+                    if filename.endswith('.tmp') and not is_abandoned(st):
+                        continue
+                    usage[path] = (st.st_size if st.st_nlink == 1 else 0, st.st_atime)
+        return usage
+
+    def evict(self, items):
+        freed = 0
+        for path in items:
+            try:
+                st = os.stat(path)
+                os.unlink(path)
+                if st.st_nlink == 1:
+                    freed += st.st_size
+            except FileNotFoundError:
+                pass
+        for dirpath, _, _ in os.walk(size_dir(self.size), topdown=False):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+        return freed
+
+    def forget(self, image_path):
+        try:
+            os.unlink(cache_path(image_path, self.size))
+        except FileNotFoundError:
             pass
-    if not os.path.isfile(scaled_path):
-        image = Image.open(image_path)
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        old_size = image.size
-        ratio = min(size[0] / old_size[0], size[1] / old_size[1])
-        new_size = (int(old_size[0] * ratio), int(old_size[1] * ratio))
-        image.resize(new_size).save(scaled_path)
-    return scaled_path
+
+
+class PackStore:
+    """
+    Stores every cached image of one size in a single append-only data file,
+    alongside an index of [key, stamp, offset, length, time] records. The data
+    file is read through an mmap, so fetching a cached image costs no syscalls
+    and images cached together can be paged in with a single contiguous read.
+
+    Originals that are no larger than the size are not copied into the pack;
+    their record has an offset of -1, meaning "read the original instead".
+
+    Access to the pack is serialised by a lock on the index (and, between threads,
+    by a mutex, as flock does not distinguish them). Garbage collection
+    replaces the pack wholesale, so anyone holding the lock must check that it is
+    still current, and discard what they know about the old pack if not.
+    """
+    flush_threshold = 100
+
+    def __init__(self, size):
+        self.size = size
+        self.dir = size_dir(size)
+        name = 'pack' + format_suffix()
+        self.data_path = os.path.join(self.dir, name + '.data')
+        self.index_path = os.path.join(self.dir, name + '.index')
+        self.access_path = os.path.join(self.dir, name + '.access')
+        self.index_ino = None
+        self.entries = {} # key -> (stamp, offset, length, time)
+        self.index_pos = 0
+        self.mmap = None
+        self.accessed = {} # key -> time, not yet written to the access log
+        self.mutex = threading.RLock()
+        atexit.register(self.flush_access)
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        with self.mutex:
+            with self._locked(exclusive) as f:
+                yield f
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        os.makedirs(self.dir, exist_ok=True)
+        while True:
+            f = open(self.index_path, 'a+b')
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            ino = os.fstat(f.fileno()).st_ino
+            try:
+                if os.stat(self.index_path).st_ino == ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        with f:
+            if ino != self.index_ino:
+                self.index_ino = ino
+                self.entries = {}
+                self.index_pos = 0
+                self.mmap = None
+            yield f
+
+    def read_index(self, f):
+        f.seek(self.index_pos)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            self.index_pos += len(line)
+            try:
+                key, *entry = json.loads(line)
+            except ValueError: # Torn by a crash mid-write; the image will be cached again
+                continue
+            self.entries[key] = tuple(entry)
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        if data_size > (len(self.mmap) if self.mmap else 0):
+            with open(self.data_path, 'rb') as data:
+                self.mmap = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def refresh(self):
+        # Pick up any records appended by other processes since we last looked
+        with self.locked() as f:
+            self.read_index(f)
+
+    def lookup(self, image_path, stamp):
+        key = cache_key(image_path)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            self.refresh()
+            entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        return entry
+
+    def is_cached(self, image_path, stamp):
+        return self.lookup(image_path, stamp) is not None
+
+    def get(self, image_path):
+        key = cache_key(image_path)
+        _stamp, offset, length, _time = self.entries[key]
+        if offset < 0:
+            with open(image_path, 'rb') as f:
+                return f.read()
+        if self.mmap is None or len(self.mmap) < offset + length:
+            self.refresh()
+            _stamp, offset, length, _time = self.entries[key]
+        return self.mmap[offset:offset + length]
+
+    def append(self, index, key, entry):
+        # Called with the exclusive lock held. If a crash left a torn record at
+        # the end of the index, finish its line, so it can't swallow ours.
+        if index.seek(0, os.SEEK_END):
+            index.seek(-1, os.SEEK_END)
+            if index.read(1) != b'\n':
+                index.write(b'\n')
+        index.write(json.dumps([key, *entry]).encode() + b'\n')
+        self.entries[key] = entry
+
+    def put(self, image_path, stamp, data):
+        key = cache_key(image_path)
+        with self.locked(exclusive=True) as index:
+            with open(self.data_path, 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            self.append(index, key, (stamp, offset, len(data), time.time()))
+        return data
+
+    def link(self, image_path, stamp):
+        key = cache_key(image_path)
+        with self.locked(exclusive=True) as index:
+            self.append(index, key, (stamp, -1, 0, time.time()))
+        return key
+
+    def touch(self, image_path, stamp):
+        with self.mutex:
+            self.accessed[cache_key(image_path)] = time.time()
+            if len(self.accessed) >= self.flush_threshold:
+                self.flush_access()
+
+    def flush_access(self):
+        with self.mutex:
+            if self.accessed:
+                with open(self.access_path, 'a', encoding='UTF-8') as f:
+                    f.writelines(json.dumps(item) + '\n' for item in self.accessed.items())
+                self.accessed = {}
+
+    def item(self, image_path):
+        return cache_key(image_path)
+
+    def usage(self):
+        self.flush_access()
+        self.refresh()
+        atimes = {}
+        if os.path.exists(self.access_path):
+            with open(self.access_path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    key, atime = json.loads(line)
+                    atimes[key] = max(atime, atimes.get(key, 0))
+        return {key: (length, max(created, atimes.get(key, 0)))
+                for key, (_stamp, _offset, length, created) in self.entries.items()}
+
+    def evict(self, items):
+        # Entries can't be removed from the pack in place, so write out a new one
+        # containing everything else. This also drops superseded entries. The
+        # usage is taken before we lock the index, so it may not include entries
+        # appended since; they keep their own time.
+        usage = self.usage()
+        with self.locked(exclusive=True) as index:
+            self.read_index(index)
+            items = set(items)
+            keep = sorted((entry[1], key, entry) for key, entry in self.entries.items()
+                          if key not in items)
+            old_size = len(self.mmap) if self.mmap else 0
+            if sum(entry[2] for _, _, entry in keep) == old_size:
+                return 0
+            offset = 0
+            with open(self.data_path + '.tmp', 'wb') as data, \
+                 open(self.index_path + '.tmp', 'wb') as new_index:
+                for _, key, (stamp, old_offset, length, created) in keep:
+                    atime = usage[key][1] if key in usage else created
+                    if old_offset < 0: # A reference to the original
+                        record = [key, stamp, old_offset, length, atime]
+                    else:
+                        data.write(self.mmap[old_offset:old_offset + length])
+                        record = [key, stamp, offset, length, atime]
+                        offset += length
+                    new_index.write(json.dumps(record).encode() + b'\n')
+            os.replace(self.data_path + '.tmp', self.data_path)
+            os.replace(self.index_path + '.tmp', self.index_path)
+            if os.path.exists(self.access_path):
+                os.unlink(self.access_path)
+        return old_size - offset
+
+    def forget(self, image_path):
+        pass # Reclaimed when the pack is next garbage collected
+
+    def prefetch(self, image_paths):
+        entries = sorted(self.entries[key][1:3] for key in map(cache_key, image_paths)
+                         if key in self.entries and self.entries[key][1] >= 0)
+        if not entries or self.mmap is None:
+            return
+        # Coalesce nearby entries so each run is paged in with one read
+        ranges = []
+        for offset, length in entries:
+            if ranges and offset - ranges[-1][1] < 65536:
+                ranges[-1][1] = max(ranges[-1][1], offset + length)
+            else:
+                ranges.append([offset, offset + length])
+        for start, end in ranges:
+            start -= start % mmap.PAGESIZE
+            end = min(end, len(self.mmap))
+            if end > start:
+                self.mmap.madvise(mmap.MADV_WILLNEED, start, end - start)
+
+
+BACKENDS = {
+    'files': FileStore,
+    'pack': PackStore,
+}
+
+STORES = {}
+def get_store(size):
+    key = (cache_dir(), BACKEND, FORMAT, tuple(size))
+    if key not in STORES:
+        STORES[key] = BACKENDS[BACKEND](size)
+    return STORES[key]
+
+
+def is_cached(image_path, size, stamp=None):
+    if stamp is None:
+        stamp = source_stamp(image_path)
+    return get_store(size).is_cached(image_path, stamp)
+
+
+def is_ready(image_path, size):
+    # As is_cached, but cheap enough to call while painting: with the global
+    # scope, an image we don't yet have a digest for counts as not cached,
+    # rather than being hashed here. The cacher will get to it.
+    if SCOPE == 'global' and DIGESTS.known(image_path) is None:
+        return False
+    return is_cached(image_path, size)
+
+
+def ensure_cached(image_path, size):
+    """
+    Returns the cached copy of image_path scaled to fit size, creating it first
+    if necessary. Depending on the backend this is either the path to a cached
+    file or the encoded image data itself.
+    """
+    return ensure_all_cached(image_path, [size])[0]
+
+
+def ensure_all_cached(image_path, sizes, resolution=None):
+    """
+    As ensure_cached, for several sizes at once. All of the sizes that are missing
+    from the cache are generated from a single decode of the original.
+    Originals are never scaled up: for any sizes they already fit within, the
+    store links to the original instead. Callers that know the resolution of
+    the original (e.g. from the library) can pass it in to save reading it.
+    """
+    stamp = source_stamp(image_path)
+    stores = [get_store(size) for size in sizes]
+    missing = {}
+    for store in stores:
+        if store.is_cached(image_path, stamp):
+            store.touch(image_path, stamp)
+        else:
+            missing[tuple(store.size)] = store
+    if missing and DAEMON is not None:
+        # If a daemon is running, let it do the work, in case anyone else wants
+        # the same image; we fall back to doing it ourselves if it can't
+        try:
+            DAEMON.ensure_cached(image_path, list(missing))
+        except (OSError, ValueError):
+            set_daemon(None)
+        missing = {size: store for size, store in missing.items()
+                   if not store.is_cached(image_path, stamp)}
+    if missing and resolution is None:
+        with Image.open(image_path) as image: # Only reads the header
+            resolution = image.size
+    for size in [size for size in missing if resolution[0] <= size[0] and resolution[1] <= size[1]]:
+        missing.pop(size).link(image_path, stamp)
+    if missing:
+        for source, sizes in cascade_sources(image_path, stamp, missing):
+            for size, image in scale_image_to_sizes(source, sizes):
+                missing[size].put(image_path, stamp, encode_image(image))
+    return [store.get(image_path) for store in stores]
+
+
+def cascade_sources(image_path, stamp, sizes):
+    """
+    Works out what to generate each of sizes from. Decoding a cached rendition is
+    much cheaper than decoding the original, so we use the smallest one that is at
+    least as large as the target, where there is one. Returns [(source, sizes)],
+    where each source is a cached image as returned by its store, or image_path.
+    """
+    sources = {}
+    renditions = sorted((size for size in cached_sizes() if size not in sizes),
+                        key=lambda size: size[0] * size[1])
+    usable = {}
+    for size in sizes:
+        for rendition in renditions:
+            if rendition[0] >= size[0] and rendition[1] >= size[1]:
+                if rendition not in usable:
+                    store = get_store(rendition)
+                    usable[rendition] = store.is_cached(image_path, stamp) and store
+                if usable[rendition]:
+                    sources.setdefault(rendition, []).append(size)
+                    break
+        else:
+            sources.setdefault(None, []).append(size)
+    return [(usable[rendition].get(image_path) if rendition else image_path, sizes)
+            for rendition, sizes in sources.items()]
+
+
+def prefetch(image_paths, size):
+    store = get_store(size)
+    if hasattr(store, 'prefetch'):
+        store.prefetch(image_paths)
+
+
+def cached_sizes():
+    if not os.path.isdir(cache_dir()):
+        return []
+    return [tuple(map(int, name.split('x'))) for name in os.listdir(cache_dir())
+            if re.fullmatch(r'\d+x\d+', name)]
+
+
+def forget_cached(image_path): # Called when image_path is deleted
+    if SCOPE == 'global': # Other libraries may have a copy
+        return
+    for size in cached_sizes():
+        get_store(size).forget(image_path)
+
+
+def dir_usage(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path) for filename in filenames)
+
+
+def remove_other_configs(size):
+    # Removes whatever other backends and formats have left in a size's
+    # directory. Returns the number of bytes reclaimed.
+    ours = {'.manifest.%s%s.json' % (BACKEND, format_suffix())}
+    if BACKEND == 'pack':
+        ours |= {'pack%s.%s' % (format_suffix(), ext) for ext in ['data', 'index', 'access']}
+    reclaimed = 0
+    for dirpath, _, filenames in os.walk(size_dir(size), topdown=False):
+        in_shard = dirpath != size_dir(size)
+        for filename in filenames:
+            if in_shard:
+                if BACKEND == 'files' and filename.endswith((FORMATS[FORMAT], '.tmp')):
+                    continue # Ours, or left to FileStore.usage
+            elif filename in ours:
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+                if filename.endswith('.tmp') and not is_abandoned(st):
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            if st.st_nlink == 1:
+                reclaimed += st.st_size
+        if in_shard:
+            try:
+                os.rmdir(dirpath)
+            except OSError: # Not empty
+                pass
+    return reclaimed
+
+
+def collect_garbage(image_paths, sizes=None, max_bytes=None):
+    """
+    Removes every cached size not in sizes (if specified), anything left by
+    other backends or formats, and cached images whose source is not in
+    image_paths. Then, if the cache is bigger than max_bytes, evicts the least
+    recently used images until it fits.
+    With the global scope, other libraries may be using images, sizes and
+    formats that this one isn't, so only the max_bytes limit is applied.
+    Returns the number of bytes reclaimed.
+    """
+    image_paths = list(image_paths)
+    reclaimed = 0
+    live = [] # (atime, bytes, size, item, image_path)
+    victims = {}
+    for size in cached_sizes():
+        if SCOPE == 'global':
+            store = get_store(size)
+            usage = store.usage()
+            victims[size] = []
+            live += [(atime, nbytes, size, item, None) for item, (nbytes, atime) in usage.items()]
+            continue
+        if sizes is not None and size not in map(tuple, sizes):
+            reclaimed += dir_usage(size_dir(size))
+            shutil.rmtree(size_dir(size))
+            continue
+        reclaimed += remove_other_configs(size)
+        store = get_store(size)
+        usage = store.usage()
+        items = {store.item(image_path): image_path for image_path in image_paths}
+        victims[size] = [item for item in usage if item not in items]
+        live += [(usage[item][1], usage[item][0], size, item, image_path)
+                 for item, image_path in items.items() if item in usage]
+
+    if max_bytes is not None:
+        total = sum(nbytes for _, nbytes, _, _, _ in live)
+        live.sort()
+        n_evicted = 0
+        for _, nbytes, size, item, _ in live:
+            if total <= max_bytes:
+                break
+            victims[size].append(item)
+            total -= nbytes
+            n_evicted += 1
+        live = live[n_evicted:]
+
+    for size, items in victims.items():
+        reclaimed += get_store(size).evict(items)
+        manifest = Manifest(size)
+        if SCOPE == 'global': # Cheaper to have the cacher check everything again than to map items back to keys
+            manifest.stamps = {}
+        else:
+            keep = {cache_key(image_path) for _, _, _size, _, image_path in live if _size == size}
+            manifest.stamps = {key: stamp for key, stamp in manifest.stamps.items() if key in keep}
+        manifest.dirty = True
+        manifest.save()
+    return reclaimed
+
+
+class Manifest:
+    """
+    Persistent record of the source stamp of every image cached at one size.
+    This lets the cacher check a whole library for work to do without touching
+    the cached files. Entries written by other processes (e.g. the GUI) are not
+    recorded here, so a miss falls back to checking the cached file itself.
+    """
+    def __init__(self, size):
+        self.path = os.path.join(size_dir(size), '.manifest.%s%s.json' % (BACKEND, format_suffix()))
+        self.size = size
+        self.dirty = False
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                self.stamps = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.stamps = {}
+
+    def is_cached(self, image_path, stamp):
+        if self.stamps.get(cache_key(image_path)) == stamp:
+            return True
+        if is_cached(image_path, self.size, stamp):
+            self.add(image_path, stamp)
+            return True
+        return False
+
+    def add(self, image_path, stamp):
+        self.stamps[cache_key(image_path)] = stamp
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump(dict(self.stamps), f) # A copy, as cacher threads may be adding to it
+        os.replace(tmp_path, self.path)
+        self.dirty = False
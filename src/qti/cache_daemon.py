@@ -0,0 +1,374 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing.connection
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from . import cache
+from .cache import BACKENDS, FORMATS, QUALITIES, SCOPES, is_cached, source_stamp
+from .cache import set_backend, set_format, set_quality, set_root_dir, set_scope
+from .image_cacher import Cacher, load_images, parse_size, report_interval_s
+from .watcher import make_watcher
+
+
+def socket_path(root_dir=None):
+    return os.path.join(root_dir or cache.ROOT_DIR, '.cache', 'daemon.sock')
+
+
+def connect(root_dir=None):
+    # Returns a socket connected to the daemon for this library, or None if
+    # there isn't one running
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(root_dir))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def cache_config():
+    # What decides whether we can read images cached by someone else
+    return {'backend': cache.BACKEND, 'format': cache.FORMAT, 'scope': cache.SCOPE}
+
+
+def make_client(root_dir=None):
+    # Returns a Client for the daemon for this library, or None if there isn't
+    # one running, or if it caches images in a form we can't read
+    sock = connect(root_dir)
+    if sock is None:
+        return None
+    client = Client(sock)
+    try:
+        config = client.request({'config': True}, Client.connect_timeout_s)['config']
+    except (OSError, ValueError, KeyError):
+        config = None
+    if config != cache_config():
+        print("Not using cache daemon: its configuration %r does not match ours %r" % (
+            config, cache_config()))
+        sock.close()
+        return None
+    return client
+
+
+class Client:
+    """
+    Synchronous requests to the daemon. Used by cache.ensure_cached to have the
+    daemon cache an image rather than doing it ourselves, so that an image that
+    several clients want at once is only generated once.
+
+    The GUI is blocked while it waits, so ensure_cached only waits briefly; if
+    the daemon is too busy to answer in time, the caller caches the image
+    itself. Replies that arrive too late are skipped by the next request.
+    """
+    timeout_s = 30
+    connect_timeout_s = 1
+    ensure_timeout_s = 1
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.partial = b''
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+
+    def request(self, msg, timeout_s=None):
+        with self.lock:
+            msg_id = next(self.ids)
+            self.sock.settimeout(self.timeout_s)
+            self.sock.sendall(json.dumps(msg | {'id': msg_id}).encode() + b'\n')
+            deadline = time.time() + (timeout_s or self.timeout_s)
+            while True:
+                while b'\n' not in self.partial:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError("No reply from cache daemon")
+                    self.sock.settimeout(remaining)
+                    data = self.sock.recv(65536)
+                    if not data:
+                        raise ConnectionError("Cache daemon has exited")
+                    self.partial += data
+                line, self.partial = self.partial.split(b'\n', 1)
+                reply = json.loads(line)
+                if reply.get('id') == msg_id:
+                    return reply
+
+    def ensure_cached(self, image_path, sizes):
+        # Returns True if the daemon cached the image at all of sizes
+        try:
+            reply = self.request({'ensure': {'path': image_path,
+                                             'sizes': [list(size) for size in sizes]}},
+                                 self.ensure_timeout_s)
+        except TimeoutError:
+            return False
+        return reply['ok']
+
+
+class Connection:
+    # The daemon's end of a client connection
+    send_timeout_s = 5
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(self.send_timeout_s)
+        self.partial = b''
+        self.sizes = []
+        self.subscribed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        # Returns a list of messages, or None if the client has gone away or
+        # sent us garbage
+        try:
+            data = self.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            return None
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        try:
+            msgs = [json.loads(line) for line in lines]
+        except ValueError: # Not a client we can talk to
+            return None
+        return msgs if all(isinstance(msg, dict) for msg in msgs) else None
+
+    def send(self, msg):
+        self.sock.sendall(json.dumps(msg).encode() + b'\n')
+
+
+class DaemonCacher(Cacher):
+    """
+    A Cacher that can also tell whoever is waiting on an image when it is done.
+    Images someone is waiting on are handed out before any other work.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = collections.defaultdict(list) # image_path -> [(connection, id)]
+
+    def in_progress(self, image_path):
+        return image_path in self.pending or self.dispatched(image_path)
+
+    def ensure(self, conn, msg):
+        image_path = msg['ensure']['path']
+        sizes = [tuple(size) for size in msg['ensure']['sizes']]
+        try:
+            stamp = source_stamp(image_path)
+        except FileNotFoundError:
+            conn.send({'id': msg['id'], 'ok': False})
+            return
+        if all(is_cached(image_path, size, stamp) for size in sizes):
+            conn.send({'id': msg['id'], 'ok': True})
+            return
+        if not set(sizes) <= set(map(tuple, self.sizes)):
+            # Not a size we're caching; the client will have to do it itself
+            conn.send({'id': msg['id'], 'ok': False})
+            return
+        if self.tasks is not None:
+            self.take_back() # So that it goes ahead of anything already queued
+        self.waiters[image_path].append((conn, msg['id']))
+        if not self.in_progress(image_path):
+            self.add_images([image_path])
+        if not self.in_progress(image_path):
+            # Our manifest thinks it's cached, but it has gone missing since
+            self.waiters[image_path].pop()
+            if not self.waiters[image_path]:
+                del self.waiters[image_path]
+            conn.send({'id': msg['id'], 'ok': False})
+            return
+        self.dispatch()
+
+    def dispatch(self):
+        # Someone is waiting on each of these, so they each get a batch of
+        # their own, ahead of the rest, even while we're paused
+        for image_path in [image_path for image_path in self.waiters
+                           if image_path in self.pending]:
+            self.put_batch([self.pending.pop(image_path)])
+        super().dispatch()
+
+    def record_results(self, results):
+        results = list(results)
+        super().record_results(results)
+        for image_path, _sizes, _stamp, error, _nbytes in results:
+            for conn, msg_id in self.waiters.pop(image_path, []):
+                try:
+                    conn.send({'id': msg_id, 'ok': error is None})
+                except OSError:
+                    pass
+
+    def forget(self, conn):
+        for image_path, waiters in list(self.waiters.items()):
+            waiters[:] = [waiter for waiter in waiters if waiter[0] is not conn]
+            if not waiters:
+                del self.waiters[image_path]
+
+
+class Daemon:
+    """
+    Owns a single worker pool for a library, shared by every qti instance that
+    is browsing it. Clients connect to a Unix socket in the cache directory and
+    send JSON lines:
+
+      {"sizes": [[w, h], ...]}       sizes this client wants cached
+      {"prioritise": [path, ...]}    cache these images next
+      {"pause": seconds}             hold off while the user is busy, other
+                                     than on images someone is waiting on
+      {"subscribe": true}            receive progress and error reports
+      {"config": true, "id": n}      reply {"id": n, "config": {...}}, the
+                                     backend, format and scope we cache with
+      {"ensure": {"path": path, "sizes": [[w, h], ...]}, "id": n}
+                                     reply {"id": n, "ok": bool} once cached
+
+    The daemon caches the union of every connected client's sizes, plus any
+    given on its command line. Requests for the same image from several clients
+    are served by a single job.
+    """
+    def __init__(self, root_dir, images, sizes, n_workers=None, resolutions=None):
+        self.root_dir = root_dir
+        self.base_sizes = [tuple(size) for size in sizes]
+        self.cacher = DaemonCacher(images, self.base_sizes, n_workers, resolutions)
+        self.connections = []
+        self.path = socket_path(root_dir)
+        self.server = None
+        self.watcher = make_watcher(root_dir)
+
+    def listen(self):
+        if connect(self.root_dir):
+            sys.exit("A cache daemon is already running for %s" % (self.root_dir,))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path): # Left behind by a daemon that didn't exit cleanly
+            os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+
+    def update_sizes(self):
+        sizes = list(self.base_sizes)
+        for conn in self.connections:
+            sizes += [size for size in conn.sizes if size not in sizes]
+        self.cacher.set_sizes(sizes)
+
+    def handle(self, conn, msg):
+        if 'sizes' in msg:
+            conn.sizes = [tuple(size) for size in msg['sizes']]
+            self.update_sizes()
+        if 'prioritise' in msg:
+            self.cacher.prioritise(msg['prioritise'])
+        if 'pause' in msg:
+            self.cacher.pause(msg['pause'])
+        if msg.get('config'):
+            conn.send({'id': msg['id'], 'config': cache_config()})
+        if msg.get('subscribe'):
+            conn.subscribed = True
+            conn.send({'type': 'progress'} | self.cacher.progress())
+        if 'ensure' in msg:
+            self.cacher.ensure(conn, msg)
+
+    def drop(self, conn):
+        self.connections.remove(conn)
+        self.cacher.forget(conn)
+        conn.sock.close()
+        if conn.sizes:
+            self.update_sizes()
+
+    def broadcast(self, msg):
+        for conn in [conn for conn in self.connections if conn.subscribed]:
+            try:
+                conn.send(msg)
+            except OSError: # Not keeping up, or gone away
+                self.drop(conn)
+
+    def run(self):
+        self.cacher.start()
+        report_at = 0
+        reported = None
+        while True:
+            self.cacher.poll()
+            for image_path, error in self.cacher.failures:
+                self.broadcast({'type': 'error', 'path': image_path, 'error': error})
+            self.cacher.failures = []
+            progress = self.cacher.progress()
+            done, total = progress['done'], progress['total']
+            if (done, total) != reported and (done >= total or time.time() >= report_at):
+                self.broadcast({'type': 'progress'} | progress)
+                report_at = time.time() + report_interval_s
+                reported = (done, total)
+
+            waitables = self.cacher.workers + self.connections + [self.server]
+            if self.watcher.fileno() is not None:
+                waitables.append(self.watcher)
+            timeout = report_interval_s
+            if self.watcher.timeout() is not None:
+                timeout = min(timeout, self.watcher.timeout())
+            ready = multiprocessing.connection.wait(waitables, timeout=timeout)
+            if self.server in ready:
+                sock, _ = self.server.accept()
+                self.connections.append(Connection(sock))
+            for conn in [conn for conn in ready if conn in self.connections]:
+                msgs = conn.read()
+                if msgs is None:
+                    self.drop(conn)
+                    continue
+                for msg in msgs:
+                    try:
+                        self.handle(conn, msg)
+                    except (OSError, KeyError, TypeError, ValueError): # Gone away, or a malformed message
+                        self.drop(conn)
+                        break
+            self.cacher.add_images(self.watcher.changes())
+
+    def stop(self):
+        self.cacher.stop()
+        if self.server:
+            self.server.close()
+            os.unlink(self.path)
+            self.server = None
+
+
+def main():
+    options = parse_cmdline()
+    root_dir, images, resolutions = load_images(options.library)
+    set_root_dir(root_dir)
+    set_backend(options.backend)
+    set_quality(options.quality)
+    set_format(options.format)
+    set_scope(options.scope)
+    daemon = Daemon(root_dir, images, options.size, options.jobs, resolutions)
+    daemon.cacher.niceness = options.nice
+    daemon.listen()
+
+    def signal_handler(signum, _):
+        daemon.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    daemon.run()
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(
+        description='Cache images for every qti instance browsing a library')
+    parser.add_argument('library', metavar='LIBRARY',
+                        help='Library JSON file, or root directory to search for images under')
+    parser.add_argument('-s', '--size', metavar='WIDTHxHEIGHT', action='append',
+                        type=parse_size, default=[],
+                        help='Cached image size, in addition to any that clients ask for')
+    parser.add_argument('-b', '--backend', choices=list(BACKENDS), default='files',
+                        help='Cache storage backend')
+    parser.add_argument('-q', '--quality', choices=list(QUALITIES), default='balanced',
+                        help='Trade off between speed (fast) and quality (best) when scaling')
+    parser.add_argument('-f', '--format', choices=list(FORMATS), default='jpeg',
+                        help='Format to store cached images in')
+    parser.add_argument('--scope', choices=list(SCOPES), default='library',
+                        help='Cache per library, or in one global cache shared between libraries')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes (default: one less than the CPU count)')
+    parser.add_argument('-n', '--nice', type=int, default=Cacher.niceness,
+                        help='Niceness increment for worker processes')
+    return parser.parse_args()
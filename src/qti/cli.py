@@ -5,7 +5,8 @@ from .app import Application
 def parse_cmdline():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--json-file', default='images.json',
-                        help="JSON image file to load")
+                        help="Library to load: a JSON file, or an SQLite database"
+                        " (ending .db or .sqlite)")
     return parser.parse_args()
 
 
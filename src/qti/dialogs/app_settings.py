@@ -1,10 +1,15 @@
 from .common import FieldDialog
 from .fields import TypedField, ColorField
-from ..settings import Color, Size
+from ..settings import CacheBackend, CacheFormat, CacheMode, CacheQuality, CacheScope, Color, Size
 
 FIELD_TYPES = {
     Color: ColorField,
     Size:  TypedField,
+    CacheBackend: TypedField,
+    CacheQuality: TypedField,
+    CacheFormat: TypedField,
+    CacheMode: TypedField,
+    CacheScope: TypedField,
     str:   TypedField,
     int:   TypedField,
     float: TypedField,
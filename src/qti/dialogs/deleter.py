@@ -14,11 +14,11 @@ def delete_nodes(app, nodes, delete_mode):
     for node in nodes:
         for image in list(node.images()):
             if delete_mode == 'set':
-                image.spec[node.type].remove(node.name)
+                image.update_set(node.type, remove={node.name})
             else:
                 if delete_mode == 'disk':
                     image.base_node.delete_file()
-                image.base_node.delete()
+                image.base_node.remove()
                 for alias in image.aliases:
                     alias.delete()
             image.delete()
@@ -75,11 +75,11 @@ class DeleterDialog(Dialog):
         delete_mode = self.ui.selected_choice()
         for image in list(node.images()):
             if delete_mode == 'set':
-                image.spec[node.type].remove(node.name)
+                image.update_set(node.type, remove={node.name})
             else:
                 if delete_mode == 'disk':
                     image.base_node.delete_file()
-                image.base_node.delete()
+                image.base_node.remove()
                 for alias in image.aliases:
                     alias.delete()
             image.delete()
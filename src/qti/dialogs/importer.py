@@ -13,12 +13,16 @@ from .fields import FieldGroup, TextField, ReadOnlyField
 from .. import ui
 
 
+def is_image_file(filename):
+    return filename.lower()[-4:] in ['.jpg', '.png']
+
+
 def find_all_images(path):
     for dirpath, _, filenames in os.walk(path):
         if '.cache/' in dirpath:
             continue
         for filename in filenames:
-            if filename.lower()[-4:] in ['.jpg', '.png']:
+            if is_image_file(filename):
                 yield os.path.join(dirpath, filename)
 
 
@@ -91,6 +95,7 @@ class ImporterDialog(DataDialog):
     def setup_grid(self):
         grid = Grid(self.app, scroll_cb=self.grid_target_updated, no_selection=True)
         cells = [{'image_path': image} for image in self.images]
+        self.app.cacher.prioritise(self.images)
         grid.load(cells)
         return grid
 
@@ -87,6 +87,7 @@ class MacroDialog(DataDialog):
         old_names = {macro['name'] for macro in self.orig_macros}
         new_names = {macro['name'] for macro in self.macros}
         self.app.library.macros = self.macros
+        self.app.library.mark_dirty()
         for name in old_names - new_names:
             self.app.keybinds.delete_action('macro_' + name)
         for name in new_names - old_names:
@@ -77,6 +77,7 @@ class MetadataEditorDialog(DataDialog):
                         self.metadata.lut[new['name']].multi = is_multi
                         self.tree.set_key_multi(name, is_multi)
         self.metadata.keys = [self.metadata.lut[entry['name']] for entry in self.data]
+        self.app.library.mark_dirty(all_specs=True)
 
         if self.metadata.hierarchy() != hierarchy:
             self.app.status_bar.set_text("WARNING: default grouping updated, app restart"
@@ -65,6 +65,14 @@ class Grid:
     def unselect(self, _action=None):
         self.unselect_cb()
 
+    def set_placeholders(self, enabled):
+        # If enabled, images that are not yet cached are left blank rather than
+        # waiting for them, and drawn when image_cached is called
+        self.ui.set_placeholders(enabled)
+
+    def image_cached(self, image_path):
+        self.ui.image_cached(image_path)
+
     def select_current_target(self, _action=None):
         if self.target_i is not None:
             self.select_cb(self.target_i)
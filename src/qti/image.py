@@ -1,23 +1,24 @@
-import PIL
+from .cache import image_size
 
 
 class Image:
-    def __init__(self, path_or_image):
-        if isinstance(path_or_image, str):
-            self.size = PIL.Image.open(path_or_image).size
-            self._path = path_or_image
+    def __init__(self, source):
+        # source is either a path, encoded image data, or a backend-specific image
+        if isinstance(source, (str, bytes)):
+            self.size = image_size(source)
+            self._source = source
             self._image = None
         else:
-            self._image = path_or_image
+            self._image = source
             self.size = self.get_size()
 
     @property
     def image(self):
         if self._image is None:
-            self._image = self.load(self._path)
+            self._image = self.load(self._source)
         return self._image
 
-    def load(self, path):
+    def load(self, source):
         raise NotImplementedError()
 
     def get_size(self):
@@ -1,107 +1,329 @@
 import argparse
-import os
+import collections
+import itertools
+import json
 import multiprocessing
 import multiprocessing.connection
+import os
+import queue
 import signal
 import sys
+import threading
 import time
 
-from .cache import cache_path, ensure_cached, set_root_dir
+from .cache import BACKENDS, FORMATS, QUALITIES, SCOPES, Manifest, collect_garbage, ensure_all_cached, source_stamp
+from .cache import set_backend, set_format, set_quality, set_root_dir, set_scope
 from .dialogs.importer import find_all_images
+from .library import load_spec
+from .watcher import make_watcher
 
 
 
 class Worker:
-    def __init__(self):
-        self.ppipe, self.cpipe = multiprocessing.Pipe()
-        self.job_count = 0
-        self.process = multiprocessing.Process(target=self.main_loop, args=(self.cpipe,))
+    def __init__(self, tasks, niceness=0):
+        self.ppipe, self.cpipe = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=self.main_loop,
+                                               args=(tasks, self.cpipe, niceness))
         self.process.start()
+        self.cpipe.close()
+        self.batch_id = None # the batch we're working on
 
     def fileno(self):
         return self.ppipe.fileno()
 
-    def dispatch(self, job):
-        self.job_count += 1
-        self.ppipe.send(job)
-
     def poll(self):
-        self.ppipe.recv()
-        self.job_count -= 1
+        # Returns None if the worker has died
+        try:
+            return self.ppipe.recv()
+        except EOFError:
+            return None
 
     def stop(self):
         self.process.terminate()
 
     # This runs in the child process
-    def main_loop(self, pipe):
-        jobs = []
+    def main_loop(self, tasks, pipe, niceness):
+        os.nice(niceness)
         while True:
-            while pipe.poll() or not jobs:
-                job = pipe.recv()
-                jobs.append(job)
-            job = jobs.pop(0)
-            ensure_cached(*job)
-            pipe.send(None)
+            batch_id, batch = tasks.get()
+            pipe.send(('taken', batch_id))
+            results = []
+            for image_path, sizes, stamp, resolution in batch:
+                try:
+                    ensure_all_cached(image_path, sizes, resolution)
+                    error = None
+                    nbytes = os.path.getsize(image_path)
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+                    nbytes = 0
+                results.append((image_path, sizes, stamp, error, nbytes))
+            pipe.send(('done', batch_id, results))
 
 
 class Cacher:
-    max_job_count = 10
+    """
+    Jobs are handed out in batches through a queue shared by all of the workers,
+    so whichever worker is free next takes the next batch. We keep a couple of
+    batches queued per worker so that none of them sit idle waiting on us.
+
+    Images can be moved to the front of the queue with prioritise(), e.g. to get
+    the images the user is currently looking at cached first.
+
+    Images that fail to cache are counted as done, and recorded in failures. If a
+    worker dies outright, the batch it was working on is failed and the worker
+    replaced. Batches that no worker has claimed when one dies are handed out
+    again, in case it died before saying which it had taken.
 
-    def __init__(self, images, sizes):
+    The set of sizes can be changed on the fly with set_sizes(), which re-plans
+    the remaining work without disturbing the workers.
+
+    Workers run at a lower priority, so they only get the CPU when nothing else
+    wants it. While the user is interacting with the GUI, it calls pause() to stop
+    us handing out work, and we take back any batches that have not been started,
+    so the workers drain quickly and leave the disk to the GUI. Work resumes once
+    the GUI stops asking.
+    """
+    batch_size = 16
+    batches_per_worker = 2
+    rate_window_s = 10
+    niceness = 10
+
+    def __init__(self, images, sizes, n_workers=None, resolutions=None):
         super().__init__()
+        self.paused_until = 0
         self.images = images
+        self.resolutions = resolutions or {} # image_path -> resolution, where known
         self.sizes = sizes
-        self.n_workers = multiprocessing.cpu_count() - 1
-        self.workers = [Worker() for i in range(self.n_workers)]
-        self.jobs = None
-        self.dispatched = self.done = self.total = self.skipped = 0
+        self.n_workers = n_workers or max(1, multiprocessing.cpu_count() - 1)
+        self.workers = []
+        self.tasks = None
+        self.manifests = {tuple(size): Manifest(size) for size in sizes}
+        self.known = {} # image_path -> None, for every image we've been asked about
+        self.pending = collections.OrderedDict() # image_path -> job
+        self.urgent = collections.deque() # image_paths
+        self.commands = queue.SimpleQueue()
+        self.batches = {} # batch_id -> batch, for batches that are queued or in progress
+        self.batch_ids = itertools.count()
+        self.failures = [] # (image_path, error), not yet reported
+        self.history = collections.deque() # (time, done, bytes_read)
+        self.done = self.total = self.skipped = self.failed = self.bytes_read = 0
 
     def start(self):
-        jobs = []
-        for image_path in self.images:
-            for size in self.sizes:
-                cached_path = cache_path(image_path, size)
-                if os.path.exists(cached_path):
-                    self.skipped += 1
-                    continue
-                jobs.append((image_path, size))
-        self.total = len(jobs)
-        self.jobs = iter(jobs)
+        self.skipped += self.add_images(self.images)
 
-    def poll(self):
+    def add_images(self, images):
+        # Returns the number of images that were already cached
+        skipped = 0
+        for image_path in images:
+            self.known[image_path] = None
+            try:
+                stamp = source_stamp(image_path)
+            except FileNotFoundError:
+                continue
+            # Each job covers every size we need for one image, so it only has to be
+            # decoded once
+            sizes = [size for size in self.sizes
+                     if not self.manifests[tuple(size)].is_cached(image_path, stamp)]
+            if not sizes:
+                skipped += 1
+                continue
+            if image_path not in self.pending:
+                self.total += 1
+            resolution = self.resolutions.get(image_path)
+            self.pending[image_path] = (image_path, sizes, stamp, resolution)
+        # Don't pay for starting workers if the cache is already warm
+        if self.pending and not self.workers:
+            self.tasks = multiprocessing.Queue()
+            self.workers = [Worker(self.tasks, self.niceness)
+                            for i in range(min(self.n_workers, len(self.pending)))]
+        self.dispatch()
+        return skipped
+
+    def dispatch(self):
+        if time.time() < self.paused_until:
+            return
+        max_queued = self.batches_per_worker * len(self.workers)
+        while self.pending and len(self.batches) < max_queued:
+            # Shrink batches as we run out of work so that it stays evenly spread
+            n = max(1, min(self.batch_size, len(self.pending) // max_queued))
+            self.put_batch([self.next_job() for i in range(n)])
+
+    def put_batch(self, batch):
+        batch_id = next(self.batch_ids)
+        self.batches[batch_id] = batch
+        self.tasks.put((batch_id, batch))
+
+    def next_job(self):
+        while self.urgent:
+            job = self.pending.pop(self.urgent.popleft(), None)
+            if job:
+                return job
+        return self.pending.popitem(last=False)[1]
+
+    def dispatched(self, image_path):
+        return any(job[0] == image_path for batch in self.batches.values() for job in batch)
+
+    def prioritise(self, image_paths):
+        # Supersedes any previous request; images already dispatched are ignored.
+        # The images may include some we've not heard of (e.g. ones the user is
+        # about to import), so make sure they are cached too.
+        self.urgent = collections.deque(image_paths)
+        dispatched = {job[0] for batch in self.batches.values() for job in batch}
+        self.add_images(image_path for image_path in self.urgent
+                        if image_path not in self.pending and image_path not in dispatched)
+
+    def pause(self, duration_s):
+        self.paused_until = max(self.paused_until, time.time() + duration_s)
+        if self.tasks is not None:
+            self.take_back()
+
+    def take_back(self):
+        # Take back any batches that no worker has started on
         while True:
-            ready = multiprocessing.connection.wait(self.workers, timeout=0)
-            if not ready:
+            try:
+                batch_id, batch = self.tasks.get_nowait()
+            except queue.Empty:
                 break
-            for worker in ready:
-                worker.poll()
-                self.done += 1
+            self.requeue(self.batches.pop(batch_id))
 
-        for worker in self.workers:
-            n = min(self.total - self.dispatched,
-                    self.max_job_count - worker.job_count)
-            if n > 0:
-                for i in range(n):
-                    self.dispatched += 1
-                    worker.dispatch(next(self.jobs))
+    def requeue(self, batch):
+        for job in reversed(batch):
+            if job[0] in self.pending: # Replanned since; don't count it twice
+                self.total -= 1
+            self.pending[job[0]] = job
+            self.pending.move_to_end(job[0], last=False)
+
+    def set_sizes(self, sizes):
+        sizes = [tuple(size) for size in sizes]
+        if sizes == [tuple(size) for size in self.sizes]:
+            return
+        for size in set(self.manifests) - set(sizes):
+            self.manifests.pop(size).save()
+        for size in sizes:
+            if size not in self.manifests:
+                self.manifests[size] = Manifest(size)
+        self.sizes = sizes
+        # Batches already handed out are left to finish; everything else is
+        # planned again from scratch
+        self.pending.clear()
+        self.history.clear()
+        self.total = sum(map(len, self.batches.values()))
+        self.done = self.failed = 0
+        self.skipped = self.add_images(list(self.known))
+
+    def handle_command(self, command):
+        if 'prioritise' in command:
+            self.prioritise(command['prioritise'])
+        if 'sizes' in command:
+            self.set_sizes(command['sizes'])
+        if 'pause' in command:
+            self.pause(command['pause'])
+
+    def poll(self, timeout=0):
+        while not self.commands.empty():
+            self.handle_command(self.commands.get())
+        if self.workers:
+            for worker in multiprocessing.connection.wait(self.workers, timeout=timeout):
+                self.handle_message(worker, worker.poll())
+            self.dispatch()
 
         if self.done == self.total:
             self.stop()
 
-        return self.done + self.skipped, self.total + self.skipped
+    def handle_message(self, worker, msg):
+        if msg is None:
+            self.workers.remove(worker)
+            batch = self.batches.pop(worker.batch_id, [])
+            worker.process.join(timeout=1)
+            exitcode = worker.process.exitcode
+            self.record_results((image_path, sizes, stamp, 'Worker died (%s)' % (exitcode,), 0)
+                                for image_path, sizes, stamp, _resolution in batch)
+            if worker.batch_id is None:
+                # It may have died after taking a batch but before telling us
+                # which, so hand out again every batch that no one has claimed
+                self.take_back()
+                claimed = {worker.batch_id for worker in self.workers}
+                for batch_id in [batch_id for batch_id in self.batches if batch_id not in claimed]:
+                    self.requeue(self.batches.pop(batch_id))
+            self.workers.append(Worker(self.tasks, self.niceness))
+        elif msg[0] == 'taken':
+            worker.batch_id = msg[1]
+        elif msg[0] == 'done':
+            _, batch_id, results = msg
+            worker.batch_id = None
+            # Unless we handed it out again, having not heard it was taken
+            if self.batches.pop(batch_id, None) is not None:
+                self.record_results(results)
+
+    def record_results(self, results):
+        for image_path, sizes, stamp, error, nbytes in results:
+            self.done += 1
+            self.bytes_read += nbytes
+            if error:
+                self.failed += 1
+                self.failures.append((image_path, error))
+            else:
+                for size in sizes:
+                    if tuple(size) in self.manifests: # Unless the size has since been dropped
+                        self.manifests[tuple(size)].add(image_path, stamp)
+
+    def progress(self):
+        now = time.time()
+        self.history.append((now, self.done, self.bytes_read))
+        while now - self.history[0][0] > self.rate_window_s:
+            self.history.popleft()
+        then, done, _ = self.history[0]
+        rate = (self.done - done) / (now - then) if now > then else 0
+        remaining = self.total - self.done
+        return {
+            'done': self.done + self.skipped,
+            'total': self.total + self.skipped,
+            'failed': self.failed,
+            'rate': round(rate, 2),
+            'bytes_read': self.bytes_read,
+            'eta': round(remaining / rate) if rate else None,
+        }
 
     def stop(self):
         for worker in self.workers:
             worker.stop()
+        self.workers = []
+        if self.tasks:
+            self.tasks.cancel_join_thread()
+            self.tasks = None
+        for manifest in self.manifests.values():
+            manifest.save()
+
+
+report_interval_s = 1.0
+
+def load_images(path):
+    # path is either a library JSON file or a directory to search for images.
+    # Returns (root_dir, images, resolutions)
+    if os.path.isdir(path):
+        return path, list(find_all_images(path)), None
+    # The library already lists every image, and usually its resolution,
+    # so there is no need to walk the filesystem or open images to plan jobs
+    spec = load_spec(path)
+    root_dir = os.path.dirname(os.path.abspath(path))
+    resolutions = {os.path.join(root_dir, image['path']): image.get('resolution')
+                   for image in spec['images']}
+    return root_dir, list(resolutions), resolutions
 
 
 def main():
     options = parse_cmdline()
-    done = -1
-    total = 0
-
+    options.root_dir, images, resolutions = load_images(options.root_dir)
     set_root_dir(options.root_dir)
-    cacher = Cacher(find_all_images(options.root_dir), options.size)
+    set_backend(options.backend)
+    set_quality(options.quality)
+    set_format(options.format)
+    set_scope(options.scope)
+    if options.gc:
+        reclaim_space(images, options)
+        return
+    cacher = Cacher(images, options.size, options.jobs, resolutions)
+    cacher.niceness = options.nice
 
     def signal_handler(signum, _):
         cacher.stop()
@@ -109,20 +331,112 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
+    if options.listen:
+        threading.Thread(target=read_commands, args=(cacher,), daemon=True).start()
+
+    watcher = make_watcher(options.root_dir) if options.watch else None
     cacher.start()
-    while done < total:
-        done, total = cacher.poll()
-        sys.stdout.write("%d %d\n" % (done, total))
-        sys.stdout.flush()
-        time.sleep(1)
+    report_at = 0
+    reported = None
+    while True:
+        cacher.poll()
+        for image_path, error in cacher.failures:
+            report({'type': 'error', 'path': image_path, 'error': error})
+        cacher.failures = []
+        progress = cacher.progress()
+        done, total = progress['done'], progress['total']
+        if (done, total) != reported and (done >= total or time.time() >= report_at):
+            report({'type': 'progress'} | progress)
+            report_at = time.time() + report_interval_s
+            reported = (done, total)
+        if watcher is None:
+            if done >= total:
+                break
+            multiprocessing.connection.wait(cacher.workers, timeout=report_interval_s)
+        else:
+            waitables = cacher.workers + ([watcher] if watcher.fileno() is not None else [])
+            timeout = report_interval_s
+            watch_timeout = watcher.timeout()
+            if watch_timeout is not None:
+                timeout = min(report_interval_s, watch_timeout)
+            multiprocessing.connection.wait(waitables, timeout=timeout)
+            cacher.add_images(watcher.changes())
+
+    if options.max_bytes is not None:
+        reclaim_space(images, options)
+
+
+def report(msg):
+    sys.stdout.write(json.dumps(msg) + '\n')
+    sys.stdout.flush()
+
+
+def read_commands(cacher):
+    # This runs in its own thread so that whoever is writing to us never blocks.
+    # We read from a copy of stdin, as sys.stdin is closed by new worker processes,
+    # which would deadlock if they were forked while we're blocked reading it.
+    with os.fdopen(os.dup(sys.stdin.fileno()), 'rb') as f:
+        for line in f:
+            cacher.commands.put(json.loads(line))
+
+
+def reclaim_space(images, options):
+    # Only an explicit --gc run drops the sizes that weren't asked for; a normal
+    # run with --max-bytes just keeps the cache within budget
+    sizes = (options.size or None) if options.gc else None
+    reclaimed = collect_garbage(images, sizes, options.max_bytes)
+    report({'type': 'gc', 'reclaimed_bytes': reclaimed, 'reclaimed': format_bytes(reclaimed)})
+
+
+UNITS = ['', 'K', 'M', 'G', 'T']
+
+def format_bytes(n):
+    for unit in UNITS[:-1]:
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = UNITS[-1]
+    return '%.1f%sB' % (n, unit)
+
+
+def parse_size(s):
+    w, h = s.split('x')
+    return (int(w), int(h))
 
 
 def parse_cmdline():
-    def size(s):
-        w, h = s.split('x')
-        return (int(w), int(h))
+    def nbytes(s):
+        unit = s[-1].upper()
+        if unit in UNITS:
+            return int(float(s[:-1]) * 1024 ** UNITS.index(unit))
+        return int(s)
     parser = argparse.ArgumentParser()
-    parser.add_argument('root_dir', help='Root directory to search for images under')
+    parser.add_argument('root_dir', metavar='LIBRARY',
+                        help='Library JSON file, or root directory to search for images under')
     parser.add_argument('-s', '--size', metavar='WIDTHxHEIGHT', action='append',
-                        type=size, default=[], help='Cached image size')
+                        type=parse_size, default=[], help='Cached image size')
+    parser.add_argument('-b', '--backend', choices=list(BACKENDS), default='files',
+                        help='Cache storage backend')
+    parser.add_argument('-q', '--quality', choices=list(QUALITIES), default='balanced',
+                        help='Trade off between speed (fast) and quality (best) when scaling')
+    parser.add_argument('-f', '--format', choices=list(FORMATS), default='jpeg',
+                        help='Format to store cached images in')
+    parser.add_argument('--scope', choices=list(SCOPES), default='library',
+                        help='Cache per library, or in one global cache shared between libraries')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes (default: one less than the CPU count)')
+    parser.add_argument('--listen', action='store_true',
+                        help='Accept commands as JSON lines on stdin, e.g. {"prioritise": [path, ...]} '
+                        'or {"sizes": [[width, height], ...]} or {"pause": seconds}')
+    parser.add_argument('-n', '--nice', type=int, default=Cacher.niceness,
+                        help='Niceness increment for worker processes')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running, caching new or modified images as they appear')
+    parser.add_argument('--gc', action='store_true',
+                        help='Instead of caching, remove cached images that are no longer needed. '
+                        'If any sizes are given, all other sizes are removed')
+    parser.add_argument('--max-bytes', metavar='BYTES', type=nbytes,
+                        help='Evict least recently used images to keep the cache within this '
+                        'size (e.g. 500M, 2G). Other sizes are only removed if --gc is also given')
     return parser.parse_args()
@@ -1,23 +1,333 @@
+import contextlib
+import copy
+import gc
 import json
+import mmap
 import os
+import pickle
+import threading
+import time
 
 from . import metadata
 from . import tree
 
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+def load_spec(json_path):
+    if json_path.endswith(SQLITE_SUFFIXES):
+        from . import sqlite_library # Imports us
+        return sqlite_library.load_spec(json_path)
+    if os.path.exists(json_path):
+        with open(json_path, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    return {'keys': [], 'images': []}
+
+
+# The snapshot is a pickle of the fully built tree, saved alongside the JSON.
+# It is only a cache: its header records the JSON's mtime and size, and if
+# those don't match (or it can't be read) we fall back to the JSON.
+# Unpickling can run arbitrary code, so in a shared library we only trust a
+# snapshot that no one else could have written.
+SNAPSHOT_VERSION = 3
+
+def snapshot_path(json_path):
+    return json_path + '.snapshot'
+
+
+def is_trusted(f):
+    st = os.fstat(f.fileno())
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+@contextlib.contextmanager
+def gc_paused():
+    # Building millions of objects that will all live as long as the library
+    # would otherwise trigger repeated, pointless full collections
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+def journal_path(json_path):
+    return json_path + '.journal'
+
+
+def json_stamp(json_path):
+    try:
+        st = os.stat(json_path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def open_library(path):
+    if path.endswith(SQLITE_SUFFIXES):
+        from .sqlite_library import SqliteLibrary
+        return SqliteLibrary(path)
+    return Library(path)
+
+
+class Journal:
+    """
+    Append-only log of edits to the library, one JSON object per line, each with
+    a sequence number. The library's JSON records the number of the last edit
+    written into it, so on load we replay any later ones. Compaction rewrites
+    the JSON and then drops the edits it now includes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.seq = 0
+        self.count = 0
+        self.since = None # When we started holding the edits we have
+
+    def load(self):
+        edits = []
+        torn = False
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        edits.append(json.loads(line))
+                    except ValueError: # Partially written when we crashed
+                        torn = True
+                        break
+        except FileNotFoundError:
+            pass
+        return edits, torn
+
+    def read(self):
+        edits, torn = self.load()
+        if torn:
+            self.rewrite(edits)
+        self.count = len(edits)
+        if edits:
+            self.seq = max(self.seq, edits[-1]['seq'])
+            self.since = time.time()
+        return edits
+
+    def append(self, edit):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='UTF-8')
+            self.seq += 1
+            self.file.write(json.dumps(edit | {'seq': self.seq}) + '\n')
+            self.file.flush()
+            self.count += 1
+            if self.since is None:
+                self.since = time.time()
+
+    def rewrite(self, edits):
+        self.close()
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            for edit in edits:
+                f.write(json.dumps(edit) + '\n')
+        os.replace(tmp_path, self.path)
+        self.count = len(edits)
+        self.since = time.time() if edits else None
+
+    def truncate(self, seq):
+        # Drops every edit up to seq
+        with self.lock:
+            edits, _ = self.load()
+            self.rewrite([edit for edit in edits if edit['seq'] > seq])
+
+    def discard_after(self, seq):
+        with self.lock:
+            edits, _ = self.load()
+            self.rewrite([edit for edit in edits if edit['seq'] <= seq])
+
+    def age(self):
+        return time.time() - self.since if self.since else 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
 class Library:
+    compact_after = 1000 # journal entries
+    compact_age_s = 3600 # age of the oldest journal entry
+
     def __init__(self, json_path):
-        self.json_path = json_path
+        self.path = self.json_path = json_path
         self.root_dir = os.path.dirname(os.path.abspath(self.json_path))
-        if os.path.exists(self.json_path):
-            with open(self.json_path, 'r', encoding='UTF-8') as f:
-                spec = json.load(f)
+        self.snapshot = None # (JSON stamp, journal seq) of the snapshot on disk
+        with gc_paused():
+            if not self.load_snapshot():
+                stamp = json_stamp(self.json_path)
+                spec = load_spec(self.json_path)
+                self.metadata = metadata.Metadata()
+                for key in spec['keys']:
+                    self.metadata.add_key(**key)
+                self.macros = spec.get('macros', [])
+                self.journal_seq = spec.get('journal_seq', 0)
+                self.base_tree = tree.BaseTree(self.root_dir, self.metadata, spec['images'])
+                if stamp:
+                    self.save_snapshot(stamp)
+        self.journal = Journal(journal_path(self.json_path))
+        self.dirty = False # Whether there are changes the journal can't express
+        self.compactor = None
+        # What has changed since the JSON was last captured for writing. Images
+        # whose specs haven't changed are copied from the JSON we last wrote.
+        self.order = None # Every image, in tree order
+        self.stale = set() # Paths of images whose specs have changed
+        self.stale_all = False
+        # Both owned by the compactor
+        self.offsets = {} # path -> where its spec is in the JSON we last wrote, as offset << 32 | length
+        self.written = None # The stamp of the JSON we last wrote
+        self.replay_journal()
+        self.base_tree.journal = self.record
+
+    def replay_journal(self):
+        edits = self.journal.read()
+        self.journal.seq = max(self.journal.seq, self.journal_seq)
+        edits = [edit for edit in edits if edit['seq'] > self.journal_seq]
+        if not edits:
+            return
+        images = {image.spec['path']: image for image in self.images()}
+        for edit in edits:
+            if edit.get('unjournaled'):
+                # Whatever came after depends on a change we never saved
+                print("Discarding edits made after an unsaved change")
+                self.journal.discard_after(self.journal_seq)
+                break
+            self.base_tree.apply_edit(edit, images)
+            self.journal_seq = edit['seq']
+
+    def record(self, edit):
+        if edit is None: # The journal can only mark the spot, so write everything out soon
+            self.dirty = True
+            self.order = None
+            edit = {'unjournaled': True}
+        elif 'specs' in edit:
+            self.stale.update(spec['path'] for spec in edit['specs'])
         else:
-            spec = {'keys': [], 'images': []}
-        self.metadata = metadata.Metadata()
-        for key in spec['keys']:
-            self.metadata.add_key(**key)
-        self.macros = spec.get('macros', [])
-        self.base_tree = tree.BaseTree(self.root_dir, self.metadata, spec['images'])
+            self.order = None
+        self.journal.append(edit)
+        self.journal_seq = self.journal.seq
+        if self.dirty or self.journal.count >= self.compact_after:
+            self.compact()
+
+    def mark_dirty(self, all_specs=False):
+        # all_specs: whether every image's spec may have changed (e.g. a key was renamed)
+        self.stale_all = self.stale_all or all_specs
+        self.record(None)
+
+    def capture(self):
+        # Takes what the compactor needs to write the library as it is now. This
+        # doesn't copy any specs: edits made while the compactor runs are after
+        # journal_seq, so replaying them fixes up any it catches half done.
+        if self.order is None:
+            self.order = list(self.images())
+        capture = {
+            'images': self.order,
+            'stale': self.stale,
+            'stale_all': self.stale_all,
+            'keys': self.metadata.json(),
+            'macros': copy.deepcopy(self.macros),
+            'journal_seq': self.journal_seq,
+        }
+        self.stale = set()
+        self.stale_all = False
+        self.dirty = False
+        return capture
+
+    def write_json(self, capture):
+        old = self.offsets
+        if capture['stale_all'] or json_stamp(self.json_path) != self.written:
+            old = {} # Unless we wrote it, we don't know what's where
+        offsets = {}
+        # Equivalent to json.dump(spec, f, indent=4)
+        rest = json.dumps({key: capture[key] for key in ['keys', 'macros', 'journal_seq']}, indent=4)
+        tmp_path = '%s.%d.tmp' % (self.json_path, os.getpid())
+        with contextlib.ExitStack() as stack:
+            if old:
+                prev = stack.enter_context(open(self.json_path, 'rb'))
+                prev = stack.enter_context(mmap.mmap(prev.fileno(), 0, access=mmap.ACCESS_READ))
+            f = stack.enter_context(open(tmp_path, 'wb'))
+            f.write(b'{\n    "images": [')
+            try:
+                for i, image in enumerate(capture['images']):
+                    f.write(b',\n        ' if i else b'\n        ')
+                    path = image.spec['path']
+                    start = f.tell()
+                    if path in old and path not in capture['stale']:
+                        offset, length = old[path] >> 32, old[path] & 0xffffffff
+                        f.write(prev[offset:offset + length])
+                    else:
+                        f.write(json.dumps(image.spec, indent=4).replace('\n', '\n' + 8 * ' ').encode())
+                    offsets[path] = start << 32 | (f.tell() - start)
+            except RuntimeError: # A spec gained or lost a key as we read it
+                f.close()
+                os.unlink(tmp_path)
+                self.dirty = True
+                return
+            f.write(b'\n    ],\n' if offsets else b'],\n')
+            f.write(rest[2:].encode())
+        os.replace(tmp_path, self.json_path)
+        self.offsets = offsets
+        self.written = json_stamp(self.json_path)
+        self.journal.truncate(capture['journal_seq'])
+
+    def compact(self):
+        if self.compactor and self.compactor.is_alive():
+            return # We'll catch up on the next edit, or on close
+        self.compactor = threading.Thread(target=self.write_json, args=(self.capture(),))
+        self.compactor.start()
+
+    def autosave(self):
+        # Called periodically. Edits are already safe in the journal, so we only
+        # rewrite the JSON for changes the journal can't express (in case the
+        # compactor was busy when they were made), or once the journal has
+        # grown long or old.
+        if (self.dirty or self.journal.count >= self.compact_after
+                or self.journal.age() > self.compact_age_s):
+            self.compact()
+
+    def snapshot_header(self, stamp):
+        return {'version': SNAPSHOT_VERSION, 'root_dir': self.root_dir, 'json': stamp}
+
+    def load_snapshot(self):
+        stamp = json_stamp(self.json_path)
+        if stamp is None:
+            return False
+        try:
+            with open(snapshot_path(self.json_path), 'rb') as f:
+                if not is_trusted(f) or pickle.load(f) != self.snapshot_header(stamp):
+                    return False
+                snapshot = pickle.load(f)
+        except Exception: # Missing, truncated, or written by an incompatible version
+            return False
+        self.metadata = snapshot['metadata']
+        self.macros = snapshot['macros']
+        self.journal_seq = snapshot['journal_seq']
+        self.base_tree = snapshot['base_tree']
+        self.snapshot = (stamp, self.journal_seq)
+        return True
+
+    def save_snapshot(self, stamp):
+        path = snapshot_path(self.json_path)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        snapshot = {'metadata': self.metadata, 'macros': self.macros,
+                    'journal_seq': self.journal_seq, 'base_tree': self.base_tree}
+        try:
+            # Not writable by anyone else, whatever the umask, or we wouldn't trust it
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            with open(fd, 'wb') as f:
+                pickle.dump(self.snapshot_header(stamp), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self.snapshot = (stamp, self.journal_seq)
+        except OSError as e: # e.g. a read-only library; we'll just load from JSON next time
+            print("Failed to save library snapshot: %s" % (e,))
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
 
     def images(self):
         return self.base_tree.images()
@@ -36,13 +346,37 @@ class Library:
         return all_values
 
     def save(self):
-        spec = {
-            'images': [image.spec for image in self.images()],
-            'keys': self.metadata.json(),
-            'macros': self.macros,
-        }
-        with open(self.json_path, 'w', encoding='UTF_8') as f:
-            json.dump(spec, f, indent=4)
+        if self.compactor:
+            self.compactor.join()
+        self.write_json(self.capture())
+        self.save_snapshot(json_stamp(self.json_path))
+
+    def close(self):
+        # Every edit is already in the journal, so unless there were changes it
+        # can't express, the JSON can wait for compaction next time
+        if self.compactor:
+            self.compactor.join()
+        self.journal.close()
+        stamp = json_stamp(self.json_path)
+        if not self.dirty and not (stamp and self.snapshot != (stamp, self.journal_seq)):
+            return
+        # Writing the JSON and pickling the tree each take seconds on a large
+        # library, which we don't want to spend on the way out, so leave them to
+        # a child process, which gets its own copy of the library for free.
+        # Without fork, the journal is replayed onto the old snapshot next time,
+        # as long as the JSON is unchanged.
+        if hasattr(os, 'fork'):
+            if os.fork() == 0:
+                try:
+                    if self.dirty:
+                        self.write_json(self.capture())
+                    stamp = json_stamp(self.json_path)
+                    if stamp:
+                        self.save_snapshot(stamp)
+                finally:
+                    os._exit(0)
+        elif self.dirty:
+            self.save()
 
     def make_tree(self, filter_config):
         return tree.FilteredTree(self.base_tree, filter_config)
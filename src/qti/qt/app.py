@@ -1,4 +1,4 @@
-from PySide6.QtCore import QTimer
+from PySide6.QtCore import Qt, QTimer, Signal
 from PySide6.QtWidgets import QMainWindow, QApplication
 
 from . import keys
@@ -58,11 +58,14 @@ class Window(QMainWindow):
 
 
 class App(QApplication):
+    thread_call = Signal(object)
+
     def __init__(self, settings, keydown_hook, exit_hook, idle_cb):
         self.settings = settings
         self.keydown_hook = keydown_hook
         self.exit_hook = exit_hook
         super().__init__([])
+        self.thread_call.connect(self.run_thread_call, Qt.QueuedConnection)
         self.size = self.primaryScreen().size().toTuple()
         self.window = Window(self)
 
@@ -79,6 +82,13 @@ class App(QApplication):
         timer.start(int(1000 * delay_s))
         return timer
 
+    def call_from_thread(self, fn, *args):
+        # Safe to call from any thread; fn is run by the event loop in the main thread
+        self.thread_call.emit(lambda: fn(*args))
+
+    def run_thread_call(self, fn):
+        fn()
+
     def run(self):
         self.window.setFixedSize(self.primaryScreen().size())
         self.window.showFullScreen()
@@ -2,7 +2,7 @@ from PySide6.QtWidgets import QWidget, QFrame, QScrollBar, QHBoxLayout
 from PySide6.QtCore import Qt, Signal, QRect, QSize
 from PySide6.QtGui import QPainter, QPen, QPalette
 
-from ..cache import ensure_cached
+from ..cache import ensure_cached, is_ready, prefetch
 from .image import Image
 
 
@@ -45,6 +45,9 @@ class Cell:
         self.contents_rect = None
         self.spacing_rect = None
 
+    def is_ready(self):
+        return self._contents is not None or is_ready(self.image_path, self.size)
+
     def contents(self):
         if self._contents is None:
             self._contents = self.render()
@@ -52,6 +55,8 @@ class Cell:
 
     def render(self):
         image = Image(ensure_cached(self.image_path, self.size))
+        if image.size[0] < self.size[0] and image.size[1] < self.size[1]:
+            image = image.scale(self.size) # Small originals are cached at their own size
         return image.center(self.size, background_color=self.settings.background_color).image
 
 
@@ -68,6 +73,7 @@ class GridBody(QWidget):
         self.setFocusPolicy(Qt.NoFocus)
         self.pos = None
         self.cells = None
+        self.placeholders = False
         self.grid_height = None
         self.grid = None
         self.target_i = None
@@ -100,6 +106,14 @@ class GridBody(QWidget):
     def viewport(self):
         return QRect(0, self.pos, *self.size().toTuple())
 
+    def visible_cells(self):
+        if not self.grid:
+            return []
+        first_row = self.pos // self.row_height
+        last_row = (self.pos + self.height()) // self.row_height
+        return [cell for row in self.grid[first_row:last_row + 1] for cell in row
+                if cell.border_rect.intersects(self.viewport)]
+
     def load(self, cells):
         self.cells = cells #[self.renderer(self.settings, **cell_dict) for cell_dict in cell_dicts]
         self.pos = 0
@@ -159,17 +173,26 @@ class GridBody(QWidget):
         painter = QPainter(self)
 
         mark_lo, mark_hi = self.marked_range()
-        for i, cell in enumerate(self.cells):
-            if cell.border_rect.intersects(self.viewport):
+        visible = self.visible_cells()
+        if self.placeholders:
+            visible_images = [cell for cell in visible if cell.is_ready()]
+        else:
+            visible_images = visible
+        unrendered = [cell.image_path for cell in visible_images if cell._contents is None]
+        if unrendered: # Page in all of the cached images we're about to load in one go
+            prefetch(unrendered, visible[0].size)
+        for cell in visible:
+            i = cell.index
+            if cell in visible_images:
                 pixmap = cell.contents()
                 painter.drawPixmap(cell.contents_rect.translated(0, -self.pos), pixmap)
-                if mark_lo <= i <= mark_hi:
-                    tmp = (self.selected if i == self.target_i else self.marked)
-                    pen = QPen(tmp.palette().color(QPalette.Text))
-                    pen.setWidth(self.border_width)
-                    pen.setJoinStyle(Qt.MiterJoin)
-                    painter.setPen(pen)
-                    painter.drawRect(cell.border_rect.translated(0, -self.pos))
+            if mark_lo <= i <= mark_hi:
+                tmp = (self.selected if i == self.target_i else self.marked)
+                pen = QPen(tmp.palette().color(QPalette.Text))
+                pen.setWidth(self.border_width)
+                pen.setJoinStyle(Qt.MiterJoin)
+                painter.setPen(pen)
+                painter.drawRect(cell.border_rect.translated(0, -self.pos))
 
 
 class GridWidget(QFrame):
@@ -214,6 +237,15 @@ class GridWidget(QFrame):
         self.body.mark_i = i
         self.body.repaint()
 
+    def set_placeholders(self, enabled):
+        self.body.placeholders = enabled
+        self.body.update()
+
+    def image_cached(self, image_path):
+        if any(cell.image_path == image_path and cell._contents is None
+               for cell in self.body.visible_cells()):
+            self.body.update()
+
     def cell_grid(self):
         return self.body.grid
 
@@ -1,11 +1,21 @@
-from PySide6.QtGui import QPixmap, QPainter
+from PySide6.QtGui import QImage, QPixmap, QPainter
 from PySide6.QtCore import Qt, QSize
 
 from ..import image
+from ..cache import read_raw
 
 class Image(image.Image):
-    def load(self, path):
-        return QPixmap(path)
+    def load(self, source):
+        raw = read_raw(source)
+        if raw: # Already in Qt's native format, so there's nothing to decode
+            width, height, pixels = raw
+            qimage = QImage(pixels, width, height, 4 * width, QImage.Format_ARGB32_Premultiplied)
+            return QPixmap.fromImage(qimage)
+        if isinstance(source, bytes):
+            pixmap = QPixmap()
+            pixmap.loadFromData(source)
+            return pixmap
+        return QPixmap(source)
 
     def get_size(self):
         return self.image.size().toTuple()
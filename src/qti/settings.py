@@ -1,5 +1,34 @@
 from .color import Color
 
+class Choice(str):
+    choices = ()
+
+    def __new__(cls, text):
+        if text not in cls.choices:
+            raise ValueError("%r is not one of: %s" % (text, ', '.join(cls.choices)))
+        return super().__new__(cls, text)
+
+
+class CacheBackend(Choice):
+    choices = ('files', 'pack')
+
+
+class CacheQuality(Choice):
+    choices = ('fast', 'balanced', 'best')
+
+
+class CacheFormat(Choice):
+    choices = ('jpeg', 'webp', 'raw', 'rawz')
+
+
+class CacheScope(Choice):
+    choices = ('library', 'global')
+
+
+class CacheMode(Choice):
+    choices = ('process', 'threads')
+
+
 class Size(list):
     def __init__(self, text):
         values = text.split()
@@ -24,6 +53,12 @@ DEFAULT_APP_SETTINGS = {
     'font_size':                 16,
     'header_font_size':          20,
     'auto_scroll_period':        5,
+    'autosave_period':           30,
+    'cache_backend':             CacheBackend('files'),
+    'cache_quality':             CacheQuality('balanced'),
+    'cache_format':              CacheFormat('jpeg'),
+    'cache_mode':                CacheMode('process'),
+    'cache_scope':               CacheScope('library'),
 }
 
 
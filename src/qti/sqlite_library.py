@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+
+from . import metadata
+from . import tree
+from .expr import Infix, Prefix, Tag
+from .library import Library, gc_paused
+from .library import load_spec as load_json_spec
+
+# Each image's full spec is stored as JSON, which is what the tree is built
+# from. image_values duplicates its key values (one row per tag for
+# multi-value keys) so they can be indexed.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    position INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    in_hierarchy INTEGER NOT NULL,
+    multi INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS macros (
+    position INTEGER PRIMARY KEY,
+    macro TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    spec TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_by_position ON images (position);
+CREATE TABLE IF NOT EXISTS image_values (
+    image_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_values_by_value ON image_values (key, value);
+CREATE INDEX IF NOT EXISTS image_values_by_image ON image_values (image_id);
+"""
+
+
+def connect(db_path):
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def read_spec(db):
+    # Returns the library in the same form as its JSON
+    keys = db.execute('SELECT name, in_hierarchy, multi FROM keys ORDER BY position')
+    images = db.execute('SELECT spec FROM images ORDER BY position')
+    macros = db.execute('SELECT macro FROM macros ORDER BY position')
+    return {
+        'keys': [{'name': name, 'in_hierarchy': bool(in_hierarchy), 'multi': bool(multi)}
+                 for name, in_hierarchy, multi in keys],
+        'images': [json.loads(spec) for spec, in images],
+        'macros': [json.loads(macro) for macro, in macros],
+    }
+
+
+def load_spec(db_path):
+    with contextlib.closing(connect(db_path)) as db:
+        return read_spec(db)
+
+
+def value_rows(image_id, spec, keys):
+    # keys is a list of (name, multi) for every non-builtin key
+    for name, multi in keys:
+        if name not in spec or spec[name] is None:
+            continue
+        for value in (spec[name] if multi else [spec[name]]):
+            yield image_id, name, value
+
+
+def insert_image(db, position, spec, keys):
+    cursor = db.execute('INSERT INTO images (position, path, spec) VALUES (?, ?, ?)',
+                        (position, spec['path'], json.dumps(spec)))
+    db.executemany('INSERT INTO image_values VALUES (?, ?, ?)',
+                   value_rows(cursor.lastrowid, spec, keys))
+
+
+def write_spec(db, spec):
+    # Replaces the whole library, in a single transaction
+    keys = [(key['name'], key['multi']) for key in spec['keys']]
+    with db:
+        for table in ['keys', 'macros', 'images', 'image_values']:
+            db.execute('DELETE FROM %s' % (table,))
+        db.executemany('INSERT INTO keys VALUES (?, ?, ?, ?)',
+                       [(i, key['name'], key['in_hierarchy'], key['multi'])
+                        for i, key in enumerate(spec['keys'])])
+        db.executemany('INSERT INTO macros VALUES (?, ?)',
+                       [(i, json.dumps(macro)) for i, macro in enumerate(spec.get('macros', []))])
+        for i, image in enumerate(spec['images']):
+            insert_image(db, i, image, keys)
+
+
+def expr_sql(expr, tag_keys):
+    # Translates a filter expression into a condition on the images table, so
+    # that the index does the matching instead of checking every image's tags.
+    # Returns (sql, args).
+    if isinstance(expr, Tag):
+        sql = 'id IN (SELECT image_id FROM image_values WHERE key IN (%s) AND value = ?)' % (
+            ', '.join('?' * len(tag_keys)),)
+        return sql, [*tag_keys, str(expr.value)]
+    if isinstance(expr, Infix):
+        lhs, lhs_args = expr_sql(expr.lhs, tag_keys)
+        rhs, rhs_args = expr_sql(expr.rhs, tag_keys)
+        op = {'&': 'AND', '|': 'OR'}[expr.symbol]
+        return '(%s %s %s)' % (lhs, op, rhs), lhs_args + rhs_args
+    if isinstance(expr, Prefix):
+        sql, args = expr_sql(expr.value, tag_keys)
+        return 'NOT (%s)' % (sql,), args
+    return '1', []
+
+
+class SqliteLibrary(Library):
+    """
+    A library kept in an SQLite database instead of JSON. Each edit is written
+    through in its own transaction as it is made, so unlike a JSON library
+    there is no journal, snapshot or compaction, and nothing to do on exit.
+    """
+    def __init__(self, db_path):
+        self.path = db_path
+        self.root_dir = os.path.dirname(os.path.abspath(db_path))
+        self.db = connect(db_path)
+        with gc_paused():
+            spec = read_spec(self.db)
+            self.metadata = metadata.Metadata()
+            for key in spec['keys']:
+                self.metadata.add_key(**key)
+            self.macros = spec['macros']
+            self.base_tree = tree.BaseTree(self.root_dir, self.metadata, spec['images'])
+        self.base_tree.journal = self.record
+
+    def value_keys(self):
+        return [(key.name, key.multi) for key in self.metadata.keys if not key.builtin]
+
+    def image_id(self, path):
+        row = self.db.execute('SELECT id FROM images WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, edit):
+        if edit is None: # Not something we can update in place
+            self.save()
+            return
+        keys = self.value_keys()
+        with self.db:
+            if 'specs' in edit:
+                for spec in edit['specs']:
+                    image_id = self.image_id(spec['path'])
+                    if image_id is None:
+                        continue
+                    self.db.execute('UPDATE images SET spec = ? WHERE id = ?',
+                                    (json.dumps(spec), image_id))
+                    self.db.execute('DELETE FROM image_values WHERE image_id = ?', (image_id,))
+                    self.db.executemany('INSERT INTO image_values VALUES (?, ?, ?)',
+                                        value_rows(image_id, spec, keys))
+            elif 'add' in edit:
+                position, = self.db.execute('SELECT COALESCE(MAX(position), -1) FROM images').fetchone()
+                for i, spec in enumerate(edit['add']):
+                    insert_image(self.db, position + 1 + i, spec, keys)
+            elif 'delete' in edit:
+                for path in edit['delete']:
+                    image_id = self.image_id(path)
+                    self.db.execute('DELETE FROM image_values WHERE image_id = ?', (image_id,))
+                    self.db.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            elif 'swap' in edit:
+                self.swap_positions(edit)
+            # A move's new values have already been recorded; the images' new
+            # position in the tree follows from them when it is next built
+
+    def swap_positions(self, edit):
+        # The tree is built by adding images in order of position, so each node
+        # comes where its first image does. The base tree has already been
+        # swapped, so we give the images under the swapped nodes (and any
+        # siblings between them) the positions they had between them, in their
+        # new order, with each node's first image ahead of the rest.
+        images = {}
+        for path in edit['swap']:
+            spec, = self.db.execute('SELECT spec FROM images WHERE path = ?', (path,)).fetchone()
+            images[path] = self.base_tree.lookup(json.loads(spec))
+        a, b = self.base_tree.swapped_nodes(edit, images)
+        siblings = a.parent.children
+        lo, hi = sorted([siblings.index(a), siblings.index(b)])
+        nodes = [list(node.images()) for node in siblings[lo:hi + 1]]
+        paths = [node[0].spec['path'] for node in nodes]
+        paths += [image.spec['path'] for node in nodes for image in node[1:]]
+        positions = sorted(self.db.execute('SELECT position FROM images WHERE path = ?', (path,)).fetchone()[0]
+                           for path in paths)
+        self.db.executemany('UPDATE images SET position = ? WHERE path = ?', zip(positions, paths))
+
+    def mark_dirty(self, all_specs=False):
+        self.save() # Key and macro changes are written out in full
+
+    def values_by_key(self):
+        all_values = {name: set() for name, _ in self.value_keys()}
+        for key, value in self.db.execute('SELECT DISTINCT key, value FROM image_values'):
+            if key in all_values:
+                all_values[key].add(value)
+        return all_values
+
+    def save(self):
+        write_spec(self.db, {
+            'images': [image.spec for image in self.images()],
+            'keys': self.metadata.json(),
+            'macros': self.macros,
+        })
+
+    def autosave(self):
+        pass # Edits are already in the database
+
+    def close(self):
+        self.db.close()
+
+    def make_tree(self, filter_config):
+        filter_expr = filter_config.filter
+        if not filter_expr:
+            return tree.FilteredTree(self.base_tree, filter_config)
+        sql, args = expr_sql(filter_expr, self.metadata.multi_value_keys())
+        paths = {path for path, in self.db.execute('SELECT path FROM images WHERE ' + sql, args)}
+        return tree.FilteredTree(self.base_tree, filter_config,
+                                 lambda image: image.spec['path'] in paths)
+
+
+def import_json(options):
+    spec = load_json_spec(options.json_file)
+    with contextlib.closing(connect(options.db_file)) as db:
+        write_spec(db, spec)
+    print("Imported %d images into %s" % (len(spec['images']), options.db_file))
+
+
+def export_json(options):
+    spec = load_spec(options.db_file)
+    tmp_path = '%s.%d.tmp' % (options.json_file, os.getpid())
+    with open(tmp_path, 'w', encoding='UTF_8') as f:
+        json.dump(spec, f, indent=4)
+    os.replace(tmp_path, options.json_file)
+    print("Exported %d images to %s" % (len(spec['images']), options.json_file))
+
+
+def main():
+    options = parse_cmdline()
+    options.func(options)
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Convert libraries between JSON and SQLite')
+    subparsers = parser.add_subparsers(required=True)
+
+    importer = subparsers.add_parser('import', help='Replace a database with the contents of a JSON file')
+    importer.set_defaults(func=import_json)
+    importer.add_argument('json_file', metavar='JSON_FILE')
+    importer.add_argument('db_file', metavar='DB_FILE')
+
+    exporter = subparsers.add_parser('export', help='Write a database out as JSON')
+    exporter.set_defaults(func=export_json)
+    exporter.add_argument('db_file', metavar='DB_FILE')
+    exporter.add_argument('json_file', metavar='JSON_FILE')
+    return parser.parse_args()
@@ -1,7 +1,9 @@
 import os
 import random
+import sys
+import types
 
-from .cache import ensure_cached
+from .cache import ensure_cached, forget_cached
 
 
 class TreeError(Exception): pass
@@ -28,8 +30,45 @@ def maybe(seq):
     return l[0] if l else None
 
 
+# A library can have millions of images, and each one appears in the base tree
+# and in every filtered tree, so nodes use __slots__, and leaves share these
+# rather than each having their own empty children and lut.
+NO_CHILDREN = ()
+NO_LUT = types.MappingProxyType({})
+NO_ALIASES = frozenset()
+NO_VALUES = [] # Never modified in place; edits always assign a new list
+
+
+def swap_edit(a, b):
+    # A journal entry for swapping two nodes, each identified by the path of an
+    # image under it
+    return {'swap': [next(node.images()).spec['path'] for node in (a, b)], 'type': a.type}
+
+
+class SpecValues:
+    # Only exists to lend its instances' __dict__s to specs. CPython stores
+    # the keys of instance dicts once per class rather than once per dict.
+    pass
+
+
+def compact_spec(spec):
+    # Returns a copy of spec that shares its keys with every other compacted
+    # spec, and its string values with every other image that has them
+    values = SpecValues()
+    for key, value in spec.items():
+        if isinstance(value, str):
+            value = sys.intern(value)
+        elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = [sys.intern(v) for v in value] if value else NO_VALUES
+        setattr(values, key, value)
+    return values.__dict__
+
+
 class Node:
+    __slots__ = ('name', 'parent')
     type = None
+    children = NO_CHILDREN
+    lut = NO_LUT
 
     def __init__(self, name):
         self.name = name
@@ -48,6 +87,9 @@ class Node:
         self.lut[child.key] = child
         return child
 
+    def record(self, edit):
+        pass # Only the base tree keeps a journal
+
     def remove_child(self, child):
         assert self.lut.get(child.key) is child
         self.children.remove(child)
@@ -106,6 +148,8 @@ class Root(Node):
 
 
 class Container(Node):
+    __slots__ = ('key', 'type', 'children', 'lut')
+
     def __init__(self, name, _type):
         super().__init__(name)
         self.type = _type
@@ -116,16 +160,31 @@ class Container(Node):
 
 
 class Image(Node):
+    __slots__ = ('spec', 'root_dir', 'base_node')
     type = 'image'
     type_label = 'image'
 
     def __init__(self, spec, root_dir):
-        super().__init__(spec['name'])
+        self.name = spec['name']
+        self.parent = None
         self.spec = spec
         self.root_dir = root_dir
-        self.abspath = os.path.join(root_dir, spec['path'])
         self.base_node = self
-        self.key = self.abspath
+
+    def __setstate__(self, state):
+        _, slots = state
+        for name, value in slots.items():
+            setattr(self, name, value)
+        if self.base_node is self: # Unpickling doesn't preserve compaction
+            self.spec = compact_spec(self.spec)
+
+    @property
+    def key(self):
+        return self.spec['path']
+
+    @property
+    def abspath(self):
+        return os.path.join(self.root_dir, self.spec['path'])
 
     def make_lut_key(self, key):
         hierarchy = self.root.metadata.hierarchy()
@@ -143,6 +202,7 @@ class Image(Node):
         if os.path.exists(self.abspath):
             print("Deleting", self.abspath)
             os.unlink(self.abspath)
+        forget_cached(self.abspath)
 
     def update_set(self, key, add=None, remove=None, toggle=None):
         keep = []
@@ -157,6 +217,13 @@ class Image(Node):
         self.spec[key] = keep
         if add:
             self.spec[key] += add
+        self.root.record({'specs': [self.spec]})
+
+    def remove(self):
+        # Deletes the image from the library, rather than just this node from its tree
+        if self.parent:
+            self.root.record({'delete': [self.spec['path']]})
+            self.delete()
 
 
 class BaseTree(Root):
@@ -164,8 +231,51 @@ class BaseTree(Root):
         super().__init__()
         self.root_dir = root_dir
         self.metadata = metadata
+        self.journal = None # Set by the library, to be called with each edit as it's made
         self.populate(images)
 
+    def __getstate__(self):
+        return self.__dict__ | {'journal': None}, {'name': self.name, 'parent': self.parent}
+
+    def record(self, edit):
+        # edit is None for changes that can't be journaled
+        if self.journal:
+            self.journal(edit)
+
+    def apply_edit(self, edit, images):
+        # Replays an edit from the journal; images maps each image's path to it
+        if 'specs' in edit:
+            for spec in edit['specs']:
+                if spec['path'] in images:
+                    images[spec['path']].spec.update(spec)
+        elif 'move' in edit:
+            moved = [images[path] for path in edit['move'] if path in images]
+            if moved:
+                self.move_images(moved, edit['key'], edit['value'])
+        elif 'delete' in edit:
+            for path in edit['delete']:
+                if path in images:
+                    images.pop(path).delete()
+        elif 'add' in edit:
+            for image in self.populate(edit['add']):
+                images[image.spec['path']] = image
+        elif 'swap' in edit:
+            if all(path in images for path in edit['swap']):
+                a, b = self.swapped_nodes(edit, images)
+                a.swap_with(b)
+
+    def swapped_nodes(self, edit, images):
+        # The nodes a swap edit refers to; images maps the edit's paths to their images
+        return [only(images[path].ancestors(lambda node: node.type == edit['type']))
+                for path in edit['swap']]
+
+    def lookup(self, spec):
+        # Finds the image with this spec by following its values down the hierarchy
+        node = self
+        for key in self.metadata.hierarchy():
+            node = node.lut[spec.get(key) or '']
+        return node.lut[spec['path']]
+
     def insert_images(self, images):
         hierarchy = self.metadata.hierarchy()
         for image in images:
@@ -186,10 +296,14 @@ class BaseTree(Root):
         images = []
         for image_spec in image_specs:
             self.metadata.normalise_image_spec(image_spec)
-            images.append(Image(image_spec, self.root_dir))
+            images.append(Image(compact_spec(image_spec), self.root_dir))
         self.insert_images(images)
+        if self.journal: # Not while loading
+            self.record({'add': [image.spec for image in images]})
+        return images
 
     def move_images(self, images, key, value):
+        self.record({'move': [image.spec['path'] for image in images], 'key': key, 'value': value})
         ancestor = only(images[0].ancestors(lambda n: n.type == key))
         parent = ancestor.parent
         new_ancestor = maybe(node for node in parent.children if node.name == value)
@@ -224,6 +338,8 @@ class BaseTree(Root):
 
 
 class FilteredContainer(Container):
+    __slots__ = ('base_node',)
+
     def __init__(self, name, _type, base_node):
         super().__init__(name, _type)
         self.base_node = base_node
@@ -233,6 +349,7 @@ class FilteredContainer(Container):
         if bs is None or bo is None:
             raise TreeError("Nodes do not map onto base tree")
         bs.swap_with(bo)
+        bs.root.record(swap_edit(bs, bo))
         super().swap_with(other)
 
     def update(self, key, value):
@@ -242,6 +359,7 @@ class FilteredContainer(Container):
         for image in images:
             image.spec[key] = value
         base_tree = self.root.base_node
+        base_tree.record({'specs': [image.spec for image in images]})
         if key in base_tree.metadata.hierarchy():
             base_tree.move_images(images, key, value)
 
@@ -277,6 +395,8 @@ class FilteredContainer(Container):
 
 
 class FilteredSet(FilteredContainer):
+    __slots__ = ()
+
     def __init__(self, name, _type):
         super().__init__(name, _type, None)
 
@@ -293,9 +413,12 @@ class FilteredSet(FilteredContainer):
                 values[values.index(self.name)] = value
             else:
                 image.spec[key] = value
+        self.root.base_node.record({'specs': [image.spec for image in self.images()]})
 
 
 class FilteredImage(Image):
+    __slots__ = ('aliases',)
+
     def __init__(self, image):
         super().__init__(image.spec, image.root_dir)
         self.base_node = image
@@ -305,11 +428,13 @@ class FilteredImage(Image):
         if bs is None or bo is None:
             raise TreeError("Nodes do not map onto base tree")
         bs.swap_with(bo)
+        bs.root.record(swap_edit(bs, bo))
         super().swap_with(other)
 
     def update(self, key, value):
         self.base_node.spec[key] = value
         base_tree = self.base_node.root
+        base_tree.record({'specs': [self.base_node.spec]})
         if key in base_tree.metadata.hierarchy():
             base_tree.move_images([self.base_node], key, value)
 
@@ -321,10 +446,11 @@ class FilteredImage(Image):
 
 
 class FilteredTree(Root):
-    def __init__(self, base_tree, filter_config):
+    def __init__(self, base_tree, filter_config, image_filter=None):
         super().__init__()
         self.base_node = base_tree
         self.filter_config = filter_config
+        self.image_filter = image_filter # Replaces filter_config.filter, if the library can do better
         self.group_by = []
         for word in filter_config.group_by:
             if ':' in word:
@@ -339,7 +465,10 @@ class FilteredTree(Root):
         hierarchy = self.base_node.metadata.hierarchy()
         filter_expr = self.filter_config.filter
         for image in self.base_node.images():
-            if filter_expr and not filter_expr.matches(image.all_tags()):
+            if self.image_filter:
+                if not self.image_filter(image):
+                    continue
+            elif filter_expr and not filter_expr.matches(image.all_tags()):
                 continue
 
             parents = [self]
@@ -379,7 +508,7 @@ class FilteredTree(Root):
 
             copies = {FilteredImage(image) for _ in parents}
             for parent, child in zip(parents, copies):
-                child.aliases = copies - {child}
+                child.aliases = copies - {child} if len(copies) > 1 else NO_ALIASES
                 parent.add_child(child)
 
         sort_keys = [SORT_TYPES.get(k) for k in self.filter_config.order_by]
@@ -387,7 +516,8 @@ class FilteredTree(Root):
         for sort_key in sort_keys:
             if sort_key:
                 for node in nodes:
-                    node.children.sort(key=sort_key)
+                    if node.children:
+                        node.children.sort(key=sort_key)
             nodes = [child for node in nodes for child in node.children]
 
     def add_key(self, key, value):
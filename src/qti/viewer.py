@@ -7,6 +7,8 @@ Image = ui.cls('image')
 
 
 class Viewer:
+    prefetch_count = 5
+
     def __init__(self, app, scroll_cb, close_cb):
         self.ui = ui.cls('viewer')(app.ui, mouse_cb=self.handle_mouse)
         self.scroll_cb = scroll_cb
@@ -32,17 +34,28 @@ class Viewer:
     def load(self, node, target):
         self.node = node
         self.target = target
+        self.prioritise_neighbours()
         self.init_image(self.target.abspath, self.size)
         self.scroll_cb(node.children.index(target))
 
     def init_image(self, image_path, window_size):
         self.window_size = window_size
-        self.scaled_path = ensure_cached(image_path, window_size)
-        self.base_image = Image(self.scaled_path)
+        self.base_image = Image(ensure_cached(image_path, window_size))
         self.raw_image = Image(self.target.abspath)
+        if self.base_image.size[0] < window_size[0] and self.base_image.size[1] < window_size[1]:
+            self.base_image = self.base_image.scale(window_size) # Small originals aren't scaled up in the cache
         self.base_zoom = self.base_image.size[0] / self.raw_image.size[0]
         self.reset_zoom()
 
+    def prioritise_neighbours(self):
+        # Get the images we're likely to scroll to next cached first
+        images = self.node.children
+        index = images.index(self.target)
+        order = [index]
+        for offset in range(1, min(self.prefetch_count, len(images) // 2) + 1):
+            order += [(index + offset) % len(images), (index - offset) % len(images)]
+        self.app.cacher.prioritise(images[i].abspath for i in order)
+
     def reset_zoom(self, _action=None):
         self.zoom_level = 0
         self.view_width = int(self.window_size[0] / self.base_zoom)
@@ -0,0 +1,138 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+
+from .dialogs.importer import is_image_file
+
+
+def is_cache_dir(path):
+    return os.path.basename(path) == '.cache' or '/.cache/' in path
+
+
+class PollingWatcher:
+    """
+    Notices new images under root_dir by polling. Only directories whose mtime
+    has changed since the last poll are listed again, so each poll costs one stat
+    per directory rather than one per image. Images that are modified in place
+    (rather than replaced) don't touch their directory's mtime and so are missed.
+    """
+    poll_interval_s = 10
+
+    def __init__(self, root_dir):
+        self.dirs = {} # path -> mtime_ns
+        self.next_poll = time.time() + self.poll_interval_s
+        self.scan(root_dir)
+
+    def fileno(self):
+        return None
+
+    def timeout(self):
+        return max(0, self.next_poll - time.time())
+
+    def scan(self, path):
+        # Returns all images found under path
+        images = []
+        try:
+            self.dirs[path] = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            self.dirs.pop(path, None)
+            return images
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self.dirs and not is_cache_dir(entry.path):
+                    images += self.scan(entry.path)
+            elif is_image_file(entry.name):
+                images.append(entry.path)
+        return images
+
+    def changes(self):
+        if time.time() < self.next_poll:
+            return []
+        self.next_poll = time.time() + self.poll_interval_s
+        images = []
+        for path, mtime in list(self.dirs.items()):
+            try:
+                changed = os.stat(path).st_mtime_ns != mtime
+            except FileNotFoundError:
+                del self.dirs[path]
+                continue
+            if changed:
+                images += self.scan(path)
+        return images
+
+
+class InotifyWatcher:
+    """
+    Notices new and modified images under root_dir using inotify. This needs a
+    watch on every directory in the tree, so may fail on a large tree if the
+    inotify watch limit is low.
+    """
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event = struct.Struct('iIII')
+
+    def __init__(self, root_dir):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {} # watch descriptor -> path
+        for dirpath, dirnames, _ in os.walk(root_dir):
+            dirnames[:] = [d for d in dirnames if not is_cache_dir(os.path.join(dirpath, d))]
+            self.watch(dirpath)
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self.dirs[wd] = path
+
+    def fileno(self):
+        return self.fd
+
+    def timeout(self):
+        return None
+
+    def changes(self):
+        images = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return images
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = self.event.unpack_from(data, offset)
+                offset += self.event.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if wd not in self.dirs:
+                    continue
+                path = os.path.join(self.dirs[wd], name)
+                if mask & self.IN_ISDIR:
+                    if not is_cache_dir(path):
+                        images += self.add_tree(path)
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and is_image_file(name):
+                    images.append(path)
+
+    def add_tree(self, path):
+        # A new directory may already have been populated before we started
+        # watching it, so return all the images it contains
+        images = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            self.watch(dirpath)
+            images += [os.path.join(dirpath, f) for f in filenames if is_image_file(f)]
+        return images
+
+
+def make_watcher(root_dir):
+    try:
+        return InotifyWatcher(root_dir)
+    except (OSError, AttributeError):
+        return PollingWatcher(root_dir)